@@ -0,0 +1,375 @@
+"""End-to-end load test: a local server and N headless bot clients.
+
+Starts server/server.py on a free port (or uses --connect), connects the
+bots over TCP and has each one send chat messages and typing updates at
+the given rates for --duration seconds. Bots are ChatSessions, the same
+client core the terminal client runs on, and each message carries its
+send time so receivers can measure send-to-receive latency.
+
+Reports message throughput, fan-out deliveries per second, latency
+percentiles and the server's RSS and CPU use, and can write them as JSON
+(--output) to compare runs across commits.
+
+Usage: python bench/load_bench.py [--clients N] [--rate MSG/S] [--duration S]
+                                  [--engine asyncio|threads] [--output FILE]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "client"))
+
+from chat_session import ChatSession
+from framing import LINES, BINARY
+
+PASSWORD = "load-bench"
+CONNECT_TIMEOUT = 10.0
+DRAIN_TIME = 2.0  # Seconds to keep reading after the bots stop sending
+# The server's per-client rate limits would drop what the bench sends and
+# skew the numbers, so a server it starts has them off (--server-arg can
+# turn them back on)
+NO_LIMITS = ["--frame-rate", "0", "--chat-rate", "0", "--typing-rate", "0"]
+
+class Stats:
+    """Counters shared by every bot"""
+
+    def __init__(self):
+        self.recording = False
+        self.sent = 0
+        self.expected = 0  # Deliveries the messages sent should cause
+        self.typing_sent = 0
+        self.received = 0
+        self.typing_received = 0
+        self.undecryptable = 0
+        self.disconnects = 0
+        self.wire_bytes = 0     # Received by bots while measuring, as sent
+        self.decoded_bytes = 0  # The same after decompression
+        self.latencies = []  # Seconds, one per delivered chat message
+
+class SharedKeys:
+    """In-memory stand-in for KeyCache, so PBKDF2 runs once per run, not per bot"""
+
+    def __init__(self):
+        self.keys = {}
+
+    def get(self, room, salt, iterations):
+        return self.keys.get((room, salt, iterations))
+
+    def put(self, room, salt, iterations, key):
+        self.keys[(room, salt, iterations)] = key
+
+    def forget(self, room):
+        pass
+
+class Bot:
+    """A headless client: a ChatSession plus send and receive loops"""
+
+    def __init__(self, name, stats, host, port, framing, keys, room=None, room_size=0,
+                 compress=False):
+        self.name = name
+        self.stats = stats
+        self.room_size = room_size  # Bots in our room, us included
+        self.session = ChatSession(host, port, framing=framing, key_cache=keys, room=room,
+                                   compress=compress)
+        self.closing = False
+
+    async def connect(self):
+        await self.session.connect(self.name, PASSWORD)
+
+    async def send_loop(self, rate, typing_rate, stop_at):
+        """Send at rate messages/s with exponential gaps, like independent users"""
+        next_message = time.monotonic() + random.expovariate(rate) if rate else None
+        next_typing = time.monotonic() + random.expovariate(typing_rate) if typing_rate else None
+        is_typing = False
+        while True:
+            now = time.monotonic()
+            if now >= stop_at:
+                break
+            if next_message is not None and now >= next_message:
+                await self.session.send(f"{self.name} {time.perf_counter():.9f}")
+                if self.stats.recording:
+                    self.stats.sent += 1
+                    self.stats.expected += self.room_size - 1
+                next_message += random.expovariate(rate)
+            if next_typing is not None and now >= next_typing:
+                is_typing = not is_typing
+                await self.session.set_typing(is_typing)
+                if self.stats.recording:
+                    self.stats.typing_sent += 1
+                next_typing += random.expovariate(typing_rate)
+            deadline = min(t for t in (next_message, next_typing, stop_at) if t is not None)
+            await asyncio.sleep(max(deadline - time.monotonic(), 0))
+
+    def _handle(self, message):
+        if message.get("username") == "System":
+            content = message.get("content", "")
+            if not self.closing and content.startswith(("Disconnected", "Connection error")):
+                self.stats.disconnects += 1
+            return
+        if message.get("type") in ("typing", "typing_status"):
+            if self.stats.recording:
+                self.stats.typing_received += 1
+            return
+        # Joins replay history; only count what was sent while measuring
+        if message.get("type") != "message" or not self.stats.recording:
+            return
+        try:
+            sent_at = float(message.get("content", "").rsplit(" ", 1)[1])
+        except (IndexError, ValueError):
+            self.stats.undecryptable += 1
+            return
+        self.stats.received += 1
+        self.stats.latencies.append(time.perf_counter() - sent_at)
+
+    async def receive_loop(self):
+        async for message in self.session:
+            self._handle(message)
+
+    async def close(self):
+        self.closing = True
+        await self.session.close()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for_port(host, port, timeout=CONNECT_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server did not start listening on port {port}")
+
+class ProcessSampler:
+    """RSS and CPU time of a process and its children, from /proc (Linux only).
+
+    Children count too, so a server running --workers is measured as a whole.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak_rss = 0
+        self.available = os.path.exists(f"/proc/{pid}/stat")
+
+    def _stat(self, pid):
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()
+
+    def pids(self):
+        """The server and its direct children (the workers)"""
+        pids = [self.pid]
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    # ppid is field 4 of stat(5)
+                    if int(self._stat(entry)[1]) == self.pid:
+                        pids.append(int(entry))
+                except (OSError, IndexError):
+                    pass
+        return pids
+
+    def cpu_seconds(self):
+        if not self.available:
+            return None
+        total = 0
+        for pid in self.pids():
+            try:
+                fields = self._stat(pid)
+            except OSError:
+                continue
+            # utime and stime, fields 14 and 15 of stat(5)
+            total += int(fields[11]) + int(fields[12])
+        return total / os.sysconf("SC_CLK_TCK")
+
+    def rss(self):
+        if not self.available:
+            return None
+        total = 0
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            total += int(line.split()[1]) * 1024
+                            break
+            except OSError:
+                continue
+        self.peak_rss = max(self.peak_rss, total)
+        return total
+
+    async def sample(self, interval=0.25):
+        while True:
+            self.rss()
+            await asyncio.sleep(interval)
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+async def run(args, host, port, sampler):
+    stats = Stats()
+    keys = SharedKeys()
+    room_sizes = [len(range(r, args.clients, args.rooms)) for r in range(args.rooms)]
+    bots = [Bot(f"bot{i}", stats, host, port, args.framing, keys,
+                room=f"bench{i % args.rooms}" if args.rooms > 1 else None,
+                room_size=room_sizes[i % args.rooms], compress=args.compress)
+            for i in range(args.clients)]
+    # The first bot derives the room key for everyone, then connect in small
+    # waves so the accept backlog isn't the thing we measure
+    await bots[0].connect()
+    for start in range(1, len(bots), 50):
+        await asyncio.gather(*(bot.connect() for bot in bots[start:start + 50]))
+    receivers = [asyncio.ensure_future(bot.receive_loop()) for bot in bots]
+    sampling = asyncio.ensure_future(sampler.sample()) if sampler else None
+
+    await asyncio.sleep(args.warmup)
+    cpu_before = sampler.cpu_seconds() if sampler else None
+    bench_cpu_before = time.process_time()
+    wire_before = sum(bot.session.bytes_received for bot in bots)
+    decoded_before = sum(bot.session.frames.fed for bot in bots)
+    stats.recording = True
+    started = time.monotonic()
+    stop_at = started + args.duration
+    await asyncio.gather(*(bot.send_loop(args.rate, args.typing_rate, stop_at) for bot in bots))
+    send_time = time.monotonic() - started
+    await asyncio.sleep(DRAIN_TIME)
+    stats.recording = False
+    elapsed = time.monotonic() - started
+    cpu_after = sampler.cpu_seconds() if sampler else None
+    bench_cpu = time.process_time() - bench_cpu_before
+    wire_bytes = sum(bot.session.bytes_received for bot in bots) - wire_before
+    decoded_bytes = sum(bot.session.frames.fed for bot in bots) - decoded_before
+
+    await asyncio.gather(*(bot.close() for bot in bots))
+    for task in receivers + ([sampling] if sampling else []):
+        task.cancel()
+    await asyncio.gather(*receivers, *([sampling] if sampling else []), return_exceptions=True)
+
+    latencies = sorted(stats.latencies)
+    expected = stats.expected
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        "messages_sent": stats.sent,
+        "messages_per_sec": round(stats.sent / send_time, 1),
+        "typing_updates_sent": stats.typing_sent,
+        "deliveries": stats.received,
+        "deliveries_per_sec": round(stats.received / elapsed, 1),
+        "delivery_ratio": round(stats.received / expected, 4) if expected else None,
+        "typing_deliveries": stats.typing_received,
+        "undecryptable": stats.undecryptable,
+        "received_bytes_per_bot": round(wire_bytes / len(bots)),
+        "decoded_bytes_per_bot": round(decoded_bytes / len(bots)),
+        "disconnects": stats.disconnects,
+        "latency_ms": {
+            "p50": ms(percentile(latencies, 0.50)),
+            "p95": ms(percentile(latencies, 0.95)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+        "server_cpu_percent": (round((cpu_after - cpu_before) / elapsed * 100, 1)
+                               if cpu_before is not None else None),
+        "server_peak_rss_bytes": sampler.peak_rss if sampler and sampler.available else None,
+        # All bots share this process; near 100% the numbers measure the bench
+        "bench_cpu_percent": round(bench_cpu / elapsed * 100, 1),
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=50, help="Number of bots")
+    parser.add_argument("--rooms", type=int, default=1,
+                        help="Spread the bots evenly over this many rooms")
+    parser.add_argument("--rate", type=float, default=1.0, help="Messages per second per bot")
+    parser.add_argument("--typing-rate", type=float, default=1.0,
+                        help="Typing status changes per second per bot")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of sending")
+    parser.add_argument("--warmup", type=float, default=1.0,
+                        help="Seconds between connecting and measuring")
+    parser.add_argument("--framing", choices=[BINARY, LINES], default=BINARY)
+    parser.add_argument("--compress", action="store_true",
+                        help="Have the bots ask for compression; compare server and bench "
+                             "cpu with a run without it")
+    parser.add_argument("--engine", default="asyncio", help="Server engine to start")
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="Extra argument for server.py (repeatable), e.g. --server-arg=--no-relay")
+    parser.add_argument("--connect", metavar="HOST:PORT",
+                        help="Use a running server instead of starting one (no RSS/CPU)")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    server = None
+    sampler = None
+    data_dir = None
+    if args.connect:
+        host, port = args.connect.rsplit(":", 1)
+        port = int(port)
+    else:
+        host, port = "127.0.0.1", free_port()
+        data_dir = tempfile.TemporaryDirectory(prefix="cowtalk-bench-")  # For the message log
+        command = [sys.executable, os.path.join(ROOT, "server", "server.py"),
+                   "--host", host, "--port", str(port), "--engine", args.engine,
+                   "--data-dir", data_dir.name] + NO_LIMITS + args.server_arg
+        server = subprocess.Popen(command, cwd=os.path.join(ROOT, "server"),
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for_port(host, port)
+        sampler = ProcessSampler(server.pid)
+
+    try:
+        results = asyncio.run(run(args, host, port, sampler))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            data_dir.cleanup()
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "results": results,
+    }
+    latency = results["latency_ms"]
+    print(f"{args.clients} clients in {args.rooms} room(s), {args.rate} msg/s each, {args.duration} s "
+          f"({args.engine if not args.connect else args.connect}, {args.framing}"
+          f"{', compressed' if args.compress else ''})")
+    print(f"  sent        {results['messages_sent']} messages, {results['messages_per_sec']} msg/s")
+    print(f"  fan-out     {results['deliveries']} deliveries, {results['deliveries_per_sec']} /s "
+          f"(ratio {results['delivery_ratio']})")
+    print(f"  typing      {results['typing_updates_sent']} updates sent, "
+          f"{results['typing_deliveries']} deliveries")
+    print(f"  latency ms  p50 {latency['p50']}  p95 {latency['p95']}  "
+          f"p99 {latency['p99']}  max {latency['max']}")
+    received, decoded = results["received_bytes_per_bot"], results["decoded_bytes_per_bot"]
+    print(f"  received    {received} bytes per bot"
+          + (f" ({decoded} decompressed, {100 - received * 100 // max(decoded, 1)}% saved)"
+             if args.compress else ""))
+    print(f"  server      cpu {results['server_cpu_percent']}%  "
+          f"peak rss {results['server_peak_rss_bytes']}  (bench cpu {results['bench_cpu_percent']}%)")
+    if results["disconnects"] or results["undecryptable"]:
+        print(f"  problems    {results['disconnects']} disconnects, "
+              f"{results['undecryptable']} undecryptable")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Micro-benchmark: server fan-out with and without the zero-parse relay.
+
+Feeds pre-built frames straight into the asyncio engine's dispatch code
+(no sockets) and reports messages per second for:
+
+  json      newline JSON in, json.loads + json.dumps, the original path
+  decode    binary frames decoded and re-encoded (server --no-relay)
+  relay     binary frames forwarded by routing header only
+
+Usage: python bench/relay_bench.py [--messages N] [--recipients N]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+import async_server
+from framing import LINES, BINARY, encode_binary, encode_line, decode_binary, peek
+
+# Roughly the size of a Fernet token for a short chat line
+CONTENT = "gAAAAAB" + "x" * 130 + "=="
+
+class Recipient:
+    """Stands in for a Connection; counts what would be written"""
+
+    def __init__(self, framing):
+        self.framing = framing
+        self.frames = 0
+        self.bytes = 0
+
+    def send(self, data):
+        self.frames += 1
+        self.bytes += len(data)
+
+class Sender:
+    """Stands in for the sending Connection"""
+    room = "bench"
+    username = "bench"
+
+def run_path(name, frames, recipients, framing):
+    members = async_server.rooms[Sender.room] = {}
+    for i in range(recipients):
+        members[i] = Recipient(framing)
+    sender = Sender()
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for frame in frames:
+            if name == "json":
+                async_server.handle_message(json.loads(frame), sender)
+            elif name == "decode":
+                async_server.handle_message(decode_binary(frame), sender)
+            else:
+                kind, sender_name = peek(frame)
+                async_server.relay(frame, kind, sender_name, sender)
+    elapsed = time.perf_counter() - started
+
+    sent = sum(r.frames for r in members.values())
+    async_server.rooms.clear()
+    return len(frames) / elapsed, sent / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--recipients", type=int, default=100)
+    args = parser.parse_args()
+
+    message = {"type": "message", "username": "alice", "content": CONTENT}
+    lines = [encode_line(message)] * args.messages
+    bodies = [encode_binary(message)[4:]] * args.messages
+
+    print(f"{args.messages} messages, {args.recipients} recipients")
+    results = {}
+    for name, frames, framing in (("json", lines, LINES),
+                                  ("decode", bodies, BINARY),
+                                  ("relay", bodies, BINARY)):
+        rate, fanout = run_path(name, frames, args.recipients, framing)
+        results[name] = rate
+        print(f"  {name:<8} {rate:>12,.0f} msg/s {fanout:>14,.0f} sends/s")
+    print(f"  relay is {results['relay'] / results['json']:.1f}x the json path")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+"""Replay a captured session against a server and compare with a baseline.
+
+Feeds traces recorded with server.py --capture back to a server, one TCP
+connection per captured connection, each sending the same connect line and
+frames at the recorded times: in real time, --speed N times faster, or with
+--speed 0 as fast as the server takes them. Traces from several workers
+(FILE.0, FILE.1, ...) are merged by time.
+
+Chat payloads are replayed as captured, so they can't carry send times like
+load_bench.py's do. Instead each delivery is matched to its send by sender
+and content (ciphertext is unique per message); messages sent before the
+receiving connection opened only arrive as backlog and aren't counted.
+
+Reports deliveries, throughput, delivery latency, how far the replay fell
+behind the trace's schedule and the server's CPU and RSS, and with
+--baseline FILE compares them to an earlier --output, exiting with status 1
+if anything got worse by more than --tolerance.
+
+Usage: python bench/replay.py TRACE [TRACE ...] [--speed N] [--output FILE]
+                              [--baseline FILE] [--engine asyncio|threads]
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from load_bench import ROOT, free_port, wait_for_port, ProcessSampler, percentile, git_commit
+
+sys.path.append(os.path.join(ROOT, "server"))
+
+from framing import (FrameReader, FrameError, LINES, BINARY, LENGTH, DEFLATE, encode,
+                     decode_line, decode_binary)
+from capture import read_trace, CONNECT, LINE, CLOSE
+
+RECV_SIZE = 65536
+HANDSHAKE_TIMEOUT = 10.0
+DRAIN_TIME = 2.0  # Seconds to keep reading after the last captured frame
+# The server's per-client rate limits would drop what the bench sends and
+# skew the numbers, so a server it starts has them off (--server-arg can
+# turn them back on)
+NO_LIMITS = ["--frame-rate", "0", "--chat-rate", "0", "--typing-rate", "0"]
+
+# Compared against the baseline: name -> whether bigger is better
+COMPARED = {
+    "deliveries_per_sec": True,
+    "latency_ms.p50": False,
+    "latency_ms.p95": False,
+    "latency_ms.p99": False,
+    "max_lag_ms": False,
+    "server_cpu_percent": False,
+    "server_peak_rss_bytes": False,
+}
+
+class Stats:
+    """Counters shared by every replayed connection"""
+
+    def __init__(self):
+        self.sent_at = {}  # (sender, content bytes) -> perf_counter() when sent
+        self.frames_sent = 0
+        self.chat_sent = 0
+        self.deliveries = 0
+        self.last_delivery = None  # perf_counter() of the last one, which ends the run
+        self.latencies = []
+        self.lags = []  # Seconds each frame went out after its scheduled time
+        self.disconnects = 0  # Connections the server closed before the trace did
+        self.failed = 0  # Connections that never got through the handshake
+        self.sending = 0  # Connections still sending
+        self.all_sent = asyncio.Event()
+
+    def done_sending(self):
+        self.sending -= 1
+        if not self.sending:
+            self.all_sent.set()
+
+def message_key(message):
+    """What identifies a chat message across framings, or None"""
+    if message.get("type") != "message" or message.get("username") == "System":
+        return None
+    content = message.get("content", "")
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return message.get("username"), content
+
+class Replayer:
+    """One captured connection, replayed on its own socket"""
+
+    def __init__(self, events, stats, address):
+        self.events = events  # (time, event, data), oldest first
+        self.stats = stats
+        self.address = address
+        self.framing = LINES
+        self.welcomed = asyncio.Event()
+        self.closing = False
+        self.connected_at = None
+        self.writer = None
+        self.receiver = None
+
+    async def run(self, start, t0, speed):
+        try:
+            await self._replay(start, t0, speed)
+        finally:
+            self.stats.done_sending()
+        if speed <= 0 and self.writer is not None:
+            # Without a schedule, leaving when the trace did would miss most
+            # deliveries; stay until everyone has sent everything
+            await self.stats.all_sent.wait()
+            await asyncio.sleep(DRAIN_TIME)
+        await self._close()
+
+    async def _replay(self, start, t0, speed):
+        connect_time, _, connect_line = self.events[0]
+        await self._wait(start, connect_time - t0, speed)
+        try:
+            reader, writer = await asyncio.open_connection(*self.address)
+        except OSError:
+            self.stats.failed += 1
+            return
+        self.writer = writer
+        self.connected_at = time.perf_counter()
+        writer.write(connect_line)
+        self.receiver = asyncio.ensure_future(self._receive(reader))
+        try:
+            await asyncio.wait_for(self.welcomed.wait(), HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats.failed += 1
+            return
+        for timestamp, event, data in self.events[1:]:
+            await self._wait(start, timestamp - t0, speed)
+            if event == CLOSE:
+                return
+            data = self._convert(data, event)
+            if data is not None and not self.receiver.done():
+                writer.write(data)
+                self.stats.frames_sent += 1
+        if speed > 0:
+            # The capture stopped before this client left; see what else arrives
+            await asyncio.sleep(DRAIN_TIME)
+
+    async def _close(self):
+        self.closing = True
+        if self.writer is not None:
+            self.writer.close()
+            self.receiver.cancel()
+            await asyncio.gather(self.receiver, return_exceptions=True)
+
+    async def _wait(self, start, offset, speed):
+        """Sleep until offset seconds into the trace, scaled by speed"""
+        if speed <= 0:
+            return
+        deadline = start + offset / speed
+        delay = deadline - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.stats.lags.append(max(time.perf_counter() - deadline, 0))
+
+    def _convert(self, data, event):
+        """A captured frame, in the framing this server agreed to"""
+        captured = LINES if event == LINE else BINARY
+        try:
+            message = decode_line(data) if captured == LINES else decode_binary(data)
+        except ValueError:
+            message = None  # Replayed as captured, if the framing allows
+        key = message_key(message) if message is not None else None
+        if key is not None:
+            self.stats.sent_at[key] = time.perf_counter()
+            self.stats.chat_sent += 1
+        if captured == self.framing:
+            return LENGTH.pack(len(data)) + data if captured == BINARY else data
+        return encode(message, self.framing) if message is not None else None
+
+    async def _receive(self, reader):
+        frames = FrameReader()
+        try:
+            while True:
+                data = await reader.read(RECV_SIZE)
+                received_at = time.perf_counter()
+                if not data:
+                    break
+                frames.feed(data)
+                while True:
+                    message = frames.next_message()
+                    if message is None:
+                        break
+                    if not self.welcomed.is_set():
+                        self.welcomed.set()
+                        if message.get("type") == "welcome":
+                            self.framing = frames.framing = message.get("framing", LINES)
+                            if message.get("compression") == DEFLATE:
+                                frames.decompress()
+                            continue
+                    self._delivered(message, received_at)
+        except (ConnectionError, FrameError, ValueError):
+            pass
+        if not self.closing:
+            self.stats.disconnects += 1
+        self.welcomed.set()
+
+    def _delivered(self, message, received_at):
+        key = message_key(message)
+        sent_at = self.stats.sent_at.get(key) if key is not None else None
+        # Anything sent before we connected can only be backlog
+        if sent_at is None or sent_at < self.connected_at:
+            return
+        self.stats.deliveries += 1
+        self.stats.last_delivery = received_at
+        self.stats.latencies.append(received_at - sent_at)
+
+def load(paths):
+    """Captured connections from every trace as lists of (time, event, data),
+    and the time of the first record
+    """
+    connections = {}
+    for index, path in enumerate(paths):
+        for timestamp, conn, event, data in read_trace(path):
+            if event == CONNECT:
+                # Connection ids restart with every worker and every run
+                connections[(index, conn)] = [(timestamp, event, data)]
+            elif (index, conn) in connections:
+                connections[(index, conn)].append((timestamp, event, data))
+    if not connections:
+        raise SystemExit("No connections in the trace")
+    t0 = min(events[0][0] for events in connections.values())
+    return list(connections.values()), t0
+
+async def run(args, host, port, sampler):
+    connections, t0 = load(args.trace)
+    trace_duration = max(events[-1][0] for events in connections) - t0
+    stats = Stats()
+    replayers = [Replayer(events, stats, (host, port)) for events in connections]
+    stats.sending = len(replayers)
+    sampling = asyncio.ensure_future(sampler.sample()) if sampler else None
+
+    cpu_before = sampler.cpu_seconds() if sampler else None
+    started = time.perf_counter()
+    await asyncio.gather(*(r.run(started, t0, args.speed) for r in replayers))
+    elapsed = time.perf_counter() - started
+    cpu_after = sampler.cpu_seconds() if sampler else None
+    if sampling:
+        sampling.cancel()
+        await asyncio.gather(sampling, return_exceptions=True)
+
+    latencies = sorted(stats.latencies)
+    # Throughput up to the last delivery, not counting the drain after it
+    active = (stats.last_delivery or started + elapsed) - started
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        "connections": len(replayers),
+        "trace_seconds": round(trace_duration, 3),
+        "replay_seconds": round(elapsed, 3),
+        "frames_sent": stats.frames_sent,
+        "messages_sent": stats.chat_sent,
+        "deliveries": stats.deliveries,
+        "deliveries_per_sec": round(stats.deliveries / active, 1) if active > 0 else None,
+        "latency_ms": {
+            "p50": ms(percentile(latencies, 0.50)),
+            "p95": ms(percentile(latencies, 0.95)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+        "max_lag_ms": ms(max(stats.lags, default=0)) if args.speed > 0 else None,
+        "disconnects": stats.disconnects,
+        "failed_connections": stats.failed,
+        "server_cpu_percent": (round((cpu_after - cpu_before) / elapsed * 100, 1)
+                               if cpu_before is not None else None),
+        "server_peak_rss_bytes": sampler.peak_rss if sampler and sampler.available else None,
+    }
+
+def lookup(results, name):
+    for part in name.split("."):
+        results = results.get(part) if isinstance(results, dict) else None
+    return results
+
+def compare(args, results, baseline):
+    """Print each compared metric against the baseline; returns the regressions"""
+    regressions = []
+    print(f"  vs baseline ({baseline.get('commit')}, {baseline.get('timestamp')})")
+    config = baseline.get("config", {})
+    if config.get("trace") != args.trace or config.get("speed") != args.speed:
+        print("    (the baseline replayed a different trace or speed)")
+    for name, bigger_is_better in COMPARED.items():
+        now, before = lookup(results, name), lookup(baseline["results"], name)
+        if now is None or before is None:
+            continue
+        change = (now - before) / before if before else 0.0
+        worse = -change if bigger_is_better else change
+        flag = ""
+        if worse > args.tolerance:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"    {name:<22} {before:>12} -> {now:<12} {change * 100:+.1f}%{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("trace", nargs="+", help="Trace file(s) from server.py --capture")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Replay N times faster than captured; 0 sends without waiting")
+    parser.add_argument("--engine", default="asyncio", help="Server engine to start")
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="Extra argument for server.py (repeatable)")
+    parser.add_argument("--connect", metavar="HOST:PORT",
+                        help="Use a running server instead of starting one (no RSS/CPU)")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="Results from an earlier --output to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="Relative change that counts as a regression (default 0.10)")
+    args = parser.parse_args()
+
+    server = None
+    sampler = None
+    data_dir = None
+    if args.connect:
+        host, port = args.connect.rsplit(":", 1)
+        port = int(port)
+    else:
+        host, port = "127.0.0.1", free_port()
+        data_dir = tempfile.TemporaryDirectory(prefix="cowtalk-replay-")  # For the message log
+        command = [sys.executable, os.path.join(ROOT, "server", "server.py"),
+                   "--host", host, "--port", str(port), "--engine", args.engine,
+                   "--data-dir", data_dir.name] + NO_LIMITS + args.server_arg
+        server = subprocess.Popen(command, cwd=os.path.join(ROOT, "server"),
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for_port(host, port)
+        sampler = ProcessSampler(server.pid)
+
+    try:
+        results = asyncio.run(run(args, host, port, sampler))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            data_dir.cleanup()
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "results": results,
+    }
+    latency = results["latency_ms"]
+    print(f"{results['connections']} connections, {results['trace_seconds']} s of trace "
+          f"replayed in {results['replay_seconds']} s (speed {args.speed})")
+    print(f"  sent        {results['frames_sent']} frames, {results['messages_sent']} chat messages")
+    print(f"  delivered   {results['deliveries']}, {results['deliveries_per_sec']} /s")
+    print(f"  latency ms  p50 {latency['p50']}  p95 {latency['p95']}  "
+          f"p99 {latency['p99']}  max {latency['max']}")
+    if results["max_lag_ms"] is not None:
+        print(f"  behind      at most {results['max_lag_ms']} ms behind schedule")
+    print(f"  server      cpu {results['server_cpu_percent']}%  "
+          f"peak rss {results['server_peak_rss_bytes']}")
+    if results["disconnects"] or results["failed_connections"]:
+        print(f"  problems    {results['disconnects']} disconnects, "
+              f"{results['failed_connections']} connections failed")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(args, results, baseline):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,415 @@
+import asyncio
+import base64
+import random
+import time
+from collections import deque
+from crypto_utils import MessageEncryption, LEGACY_SALT, DEFAULT_ITERATIONS, FERNET
+from framing import FrameReader, FrameError, LINES, BINARY, DEFLATE, encode
+from perf import profiler
+
+HANDSHAKE_TIMEOUT = 10  # Seconds to wait for the server's first frame
+RECV_SIZE = 65536       # Bytes per socket read
+BATCH_SIZE = 64         # Most messages decrypted in one call
+INLINE_BATCH = 8        # Smaller batches are decrypted on the event loop
+TYPING_REFRESH = 1.0    # Least seconds between two "still typing" updates; servers
+                        # expire typists after a few seconds without one
+RECONNECT_MIN = 0.5     # Seconds before the second reconnect attempt, doubling after each
+RECONNECT_MAX = 30.0    # Longest wait between reconnect attempts
+
+def system_message(content):
+    return {"type": "message", "username": "System", "content": content}
+
+class ChatSession:
+    """A cowtalk connection without any UI, for asyncio code.
+
+        session = ChatSession(host, port)
+        await session.connect("alice", "room password")
+        await session.send("hello")
+        async for message in session:
+            ...
+
+    Iterating yields decrypted message dicts from other users in the order
+    the server sent them, ending when the connection closes. Received data is
+    parsed as soon as it arrives and larger batches are decrypted in the
+    loop's default executor, so decryption never holds up reading the
+    socket; the iterator awaits those batches in order. Sessions are cheap,
+    so one process can run hundreds of them.
+
+    If the connection drops, the session reconnects with exponential
+    backoff and tells the server the last seq it saw, so the messages it
+    missed come through as if nothing happened. The room key is kept
+    unless the server has changed the room's settings.
+    """
+
+    def __init__(self, host='localhost', port=9999, framing=BINARY, key_cache=None,
+                 forget_key=False, room=None, reconnect=True, compress=False):
+        self.host = host
+        self.port = port
+        self.room = room  # Asked for at connect; None lets the server pick
+        self.requested_framing = framing  # Asked for in the connect message
+        self.framing = LINES  # What we actually speak until the server agrees
+        self.key_cache = key_cache  # KeyCache (or anything with get/put/forget), optional
+        self.forget_key = forget_key
+        self.reconnect = reconnect
+        self.compress = compress  # Ask the server to deflate what it sends us
+        self.username = None
+        self.encryption = None
+        self.welcome = None
+        self.settings = None  # Welcome or room message the current key was set up for
+        self.last_seq = None  # Seq of the newest chat message seen in this room
+        self.epoch = None  # The room's history epoch last_seq counts in, if it has one
+        self.password = None  # Kept to derive keys for rooms we /join later
+        self.room_passwords = {}  # Rooms joined with a password of their own
+        self.reader = None
+        self.writer = None
+        self.frames = FrameReader()
+        self.bytes_received = 0  # Off the socket, before decompression
+        self.batches = deque()  # Futures of decrypted batches, in arrival order
+        self.batch_ready = asyncio.Event()
+        self.delivering = deque()  # Decrypted messages not yet handed out
+        self.receiver = None
+        self.connected = False
+        self.closing = False  # close() was called; don't reconnect
+        self.closed = False
+        self.is_typing = False
+        self.last_typing_update = 0
+
+    async def connect(self, username, password):
+        """Connect, agree on framing and set up the room key.
+
+        password may be a callable, which is then only called (in an
+        executor, so it may block) when the key isn't in the key cache.
+        It's only called here: rooms joined later without a password of
+        their own need a cached key, or the password it returned.
+        """
+        loop = asyncio.get_running_loop()
+        self.username = username
+        self.password = password
+        early = await self._open()
+        self.encryption = await self._init_encryption(self.welcome)
+        self.settings = self.welcome
+        if callable(self.password):
+            self.password = None  # Never prompt once the caller has the terminal
+        self._submit(early)
+        self.receiver = loop.create_task(self._receive_loop())
+
+    async def _open(self):
+        """Open a connection and do the handshake; returns early messages"""
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.framing = LINES
+        self.frames = FrameReader()
+        self.welcome = None
+        connect = {
+            "type": "connect",
+            "username": self.username,
+            "framing": self.requested_framing
+        }
+        if self.compress:
+            connect["compression"] = DEFLATE
+        if self.room is not None:
+            connect["room"] = self.room
+        if self.last_seq is not None:
+            connect["last_seq"] = self.last_seq
+            if self.epoch is not None:
+                connect["epoch"] = self.epoch
+        self.writer.write(encode(connect))
+        try:
+            early = await asyncio.wait_for(self._handshake(), HANDSHAKE_TIMEOUT)
+        except BaseException:
+            self.writer.close()
+            raise
+        if self.welcome:
+            self.room = self.welcome.get("room")
+        self.connected = True
+        return early
+
+    async def _handshake(self):
+        """Wait for the server's first frame and switch framing if agreed.
+
+        Returns messages to process once we have a key.
+        """
+        message = None
+        while message is None:
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            self.bytes_received += len(data)
+            self.frames.feed(data)
+            message = self.frames.next_message()
+
+        if message.get("type") == "welcome":
+            self.welcome = message
+            self._set_epoch(message.get("epoch"))
+            self.framing = message.get("framing", LINES)
+            # Anything after the welcome is already in the new framing,
+            # and compressed if the server agreed to that
+            self.frames.framing = self.framing
+            if message.get("compression") == DEFLATE:
+                self.frames.decompress()
+            return []
+        # Older servers don't send a welcome; this is a regular message
+        return [message]
+
+    async def _init_encryption(self, settings):
+        """Set up encryption for a room, from the key cache if possible.
+
+        settings is the welcome or room message with the room's salt; older
+        servers send neither.
+        """
+        if settings and settings.get("salt"):
+            salt = base64.b64decode(settings["salt"])
+            iterations = settings.get("kdf_iterations", DEFAULT_ITERATIONS)
+            cipher = settings.get("cipher", FERNET)
+            room = f"{self.host}:{self.port}/{settings.get('room')}"
+        else:
+            salt, iterations, cipher = LEGACY_SALT, DEFAULT_ITERATIONS, FERNET
+            room = f"{self.host}:{self.port}"
+
+        if self.key_cache:
+            if self.forget_key:
+                self.key_cache.forget(room)
+            else:
+                key = self.key_cache.get(room, salt, iterations)
+                if key:
+                    return MessageEncryption(key=key, cipher=cipher)
+
+        loop = asyncio.get_running_loop()
+        password = self.room_passwords.get(settings.get("room") if settings else None,
+                                           self.password)
+        if callable(password):
+            password = self.password = await loop.run_in_executor(None, password)
+        elif password is None:
+            raise ValueError("no password for it and no cached key")
+        # PBKDF2 is deliberately slow; keep it off the event loop
+        encryption = await loop.run_in_executor(
+            None, lambda: MessageEncryption(password, salt, iterations, cipher=cipher))
+        if self.key_cache:
+            self.key_cache.put(room, salt, iterations, encryption.key)
+        return encryption
+
+    async def send(self, text):
+        """Encrypt and send a chat message"""
+        await self._send({
+            "type": "message",
+            "username": self.username,
+            "content": self.encryption.encrypt_message(text)
+        })
+
+    async def join(self, room, password=None):
+        """Switch rooms. The key for the new room is derived from password,
+        or the one given to connect(); messages from the new room are
+        yielded after a "Now in room" notice.
+        """
+        if password is not None:
+            self.room_passwords[room] = password
+        await self._send({"type": "join", "room": room})
+
+    async def set_typing(self, is_typing):
+        """Report whether we're typing; call it on every keystroke, repeats
+        are rate limited. Servers answer with "typing" snapshots listing
+        everyone typing in the room (minus us), sent only when that changes.
+        """
+        now = time.monotonic()
+        # Always send if state changes, otherwise respect rate limit
+        if is_typing == self.is_typing and now - self.last_typing_update < TYPING_REFRESH:
+            return
+        self.is_typing = is_typing
+        self.last_typing_update = now
+        await self._send({
+            "type": "typing_status",
+            "username": self.username,
+            "is_typing": is_typing
+        })
+
+    async def _send(self, message):
+        if not self.connected:
+            raise ConnectionError("Not connected to the server")
+        self.writer.write(encode(message, self.framing))
+        await self.writer.drain()
+
+    async def close(self):
+        """Close the connection; iteration ends after what was received"""
+        self.closing = True
+        if not self.connected and self.receiver is not None:
+            self.receiver.cancel()  # Stop reconnecting
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    def queue_depths(self):
+        """Batches being decrypted and messages waiting to be handed out"""
+        batches = list(self.batches)  # May be called from another thread
+        done = [batch for batch in batches if batch.done() and not batch.exception()]
+        return {
+            "decrypt": len(batches) - len(done),
+            "deliver": sum(len(batch.result()) for batch in done) + len(self.delivering),
+        }
+
+    def _decrypt(self, messages, encryption):
+        """Drop our own messages from a batch and decrypt the rest"""
+        # Only process messages that aren't our own
+        messages = [m for m in messages if m.get("username") != self.username]
+        for message in messages:
+            if message.get("type") == "typing":
+                message["users"] = [u for u in message.get("users", []) if u != self.username]
+            elif message.get("type") == "roster":
+                for field in ("users", "joined", "left"):
+                    if field in message:
+                        message[field] = [u for u in message[field] if u != self.username]
+        # Decrypt the content of regular chat messages (not system messages)
+        # in one call, which keeps per-message overhead down for replays
+        encrypted = [m for m in messages
+                     if m.get("type") == "message" and m.get("username") != "System"
+                     and m.get("content")]
+        if encrypted:
+            started = time.perf_counter() if profiler.enabled else None
+            decrypted = encryption.decrypt_many([m["content"] for m in encrypted])
+            if started is not None:
+                profiler.observe("decrypt", (time.perf_counter() - started) / len(encrypted),
+                                 len(encrypted))
+            for message, content in zip(encrypted, decrypted):
+                message["content"] = content or "[Encrypted message - cannot decrypt]"
+        return messages
+
+    def _submit(self, messages):
+        """Queue a parsed batch for decryption, keeping arrival order"""
+        loop = asyncio.get_running_loop()
+        # Each batch keeps the key it arrived under, even if we change rooms
+        # before it's decrypted
+        if len(messages) > INLINE_BATCH:
+            batch = loop.run_in_executor(None, self._decrypt, messages, self.encryption)
+        else:
+            batch = loop.create_future()
+            batch.set_result(self._decrypt(messages, self.encryption))
+        self.batches.append(batch)
+        self.batch_ready.set()
+
+    async def _receive_loop(self):
+        try:
+            while True:
+                reason = await self._read_stream()
+                self.connected = False
+                self.writer.close()
+                if self.closing or not self.reconnect:
+                    self._submit([system_message(reason)])
+                    break
+                self._submit([system_message(f"{reason}, reconnecting...")])
+                await self._reconnect()
+        except asyncio.CancelledError:
+            raise
+        finally:
+            self.connected = False
+            self.closed = True
+            self.batch_ready.set()
+
+    async def _reconnect(self):
+        """Connect again with exponential backoff and pick up where we left off"""
+        delay = RECONNECT_MIN
+        while True:
+            try:
+                early = await self._open()
+                break
+            except (OSError, asyncio.TimeoutError, ValueError):
+                # Jitter keeps a room full of clients from retrying in lockstep
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+                delay = min(delay * 2, RECONNECT_MAX)
+        if not self._same_key(self.welcome, self.settings):
+            await self._change_room(self.welcome)
+        self._submit([system_message("Reconnected")] + early)
+
+    def _set_epoch(self, epoch):
+        """Note the room's history epoch from a welcome. A new one means the
+        server started its numbering over and has sent us everything it
+        has, so we've seen nothing in it yet rather than up to last_seq
+        """
+        if self.last_seq is not None and epoch != self.epoch:
+            self.last_seq = -1
+        self.epoch = epoch
+
+    @staticmethod
+    def _same_key(settings, previous):
+        """Whether two welcome/room messages lead to the same room key"""
+        fields = ("room", "salt", "kdf_iterations", "cipher")
+        return [(settings or {}).get(f) for f in fields] == [(previous or {}).get(f) for f in fields]
+
+    async def _read_stream(self):
+        """Parse and submit what the server sends until the connection ends.
+
+        Returns why it ended.
+        """
+        try:
+            while True:
+                batch = []
+                try:
+                    while True:
+                        try:
+                            message = self.frames.next_message()
+                        except FrameError:
+                            raise
+                        except ValueError as e:
+                            batch.append(system_message(f"Error decoding message: {e}"))
+                            continue
+                        if message is None:
+                            break
+                        if message.get("type") == "room":
+                            # Everything after this is from the new room
+                            if batch:
+                                self._submit(batch)
+                                batch = []
+                            self.last_seq = None
+                            self.epoch = message.get("epoch")
+                            await self._change_room(message)
+                            continue
+                        if message.get("seq") is not None:
+                            self.last_seq = message["seq"]
+                        batch.append(message)
+                        if len(batch) >= BATCH_SIZE:
+                            self._submit(batch)
+                            batch = []
+                finally:
+                    if batch:
+                        self._submit(batch)
+
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    return "Disconnected from server"
+                self.bytes_received += len(data)
+                if profiler.enabled:
+                    profiler.add("net_rx_bytes", len(data))
+                self.frames.feed(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Includes FrameError: the stream is out of sync, so stop reading
+            return f"Connection error: {e}"
+
+    async def _change_room(self, settings):
+        try:
+            self.encryption = await self._init_encryption(settings)
+        except Exception as e:
+            self._submit([system_message(f"Can't set up the key for {settings.get('room')}: {e}")])
+            return
+        self.settings = settings
+        self.room = settings.get("room")
+        self._submit([system_message(f"Now in room {self.room}")])
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.delivering:
+            if self.batches:
+                batch = self.batches.popleft()
+                try:
+                    self.delivering.extend(await batch)
+                except Exception as e:
+                    self.delivering.append(system_message(f"Error processing message: {e}"))
+            elif self.closed:
+                raise StopAsyncIteration
+            else:
+                self.batch_ready.clear()
+                await self.batch_ready.wait()
+        return self.delivering.popleft()
@@ -1,184 +1,240 @@
-import socket
-import threading
+import argparse
+import asyncio
+import os
+import signal
 import sys
-import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from getpass import getpass
-from crypto_utils import MessageEncryption
+from crypto_utils import (MessageEncryption, KeyCache, LEGACY_SALT, DEFAULT_ITERATIONS,
+                          time_derivation, calibrate_iterations)
+from chat_session import ChatSession
+from framing import LINES, BINARY
 from terminal_ui import ChatUI
+from scrollback import MAX_MESSAGES
+from perf import profiler
 import time
 
+DECRYPT_WORKERS = 2  # Threads decrypting large batches of received messages
+
 class CowtalkClient:
-    def __init__(self, host='localhost', port=9999):
-        self.host = host
-        self.port = port
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.username = None
-        self.encryption = None
-        self.ui = ChatUI()
-        self.last_typing_update = 0
-        self.typing_update_delay = 0.1  # Reduce to 100ms for more responsive updates
-        
-    def connect(self):
+    """Terminal front end: a ChatUI driven by a ChatSession.
+
+    Everything runs on one asyncio loop on the main thread. It sleeps until
+    stdin is readable, a message arrives, the terminal is resized
+    (SIGWINCH) or the UI has a frame or typing expiry due, and it does all
+    the drawing. Only decryption of large batches runs on other threads.
+    """
+
+    def __init__(self, host='localhost', port=9999, use_cowsay_binary=False, frame_rate=30,
+                 scrollback=MAX_MESSAGES, framing=BINARY, key_cache=None, forget_key=False,
+                 decrypt_workers=DECRYPT_WORKERS, room=None, reconnect=True, compress=False,
+                 perf_dump=None):
+        self.session = ChatSession(host, port, framing=framing, key_cache=key_cache,
+                                   forget_key=forget_key, room=room, reconnect=reconnect,
+                                   compress=compress)
+        self.ui = ChatUI(use_cowsay_binary=use_cowsay_binary, frame_rate=frame_rate,
+                         max_messages=scrollback)
+        self.decrypt_workers = decrypt_workers
+        self.perf_dump = perf_dump  # Profile the whole session and write it here on exit
+        profiler.enabled = perf_dump is not None
+        self.wake = None  # asyncio.Event set by anything the loop should react to
+
+    @property
+    def username(self):
+        return self.session.username
+
+    async def connect(self):
         """Connect to the server"""
+        loop = asyncio.get_running_loop()
         try:
-            self.socket.connect((self.host, self.port))
-            self.username = input("Enter your username: ")
-            # Initialize encryption with a password
-            password = getpass("Enter encryption password: ")
-            self.encryption = MessageEncryption(password)
-            # Send username to server
-            self.send_message({"type": "connect", "username": self.username})
+            username = await loop.run_in_executor(None, input, "Enter your username: ")
+            await self.session.connect(username, lambda: getpass("Enter encryption password: "))
             return True
         except Exception as e:
             print(f"Connection error: {e}")
             return False
-            
-    def send_message(self, message_dict):
-        """Send a message to the server"""
+
+    async def send_chat(self, text):
+        """Show a chat message locally and send it"""
+        # Add an unencrypted copy to the UI
+        self.ui.add_message({
+            "type": "message",
+            "username": self.username,
+            "content": text
+        })
         try:
-            # Add message to UI immediately if it's a chat message
-            if message_dict.get("type") == "message":
-                # Add an unencrypted copy to the UI
-                self.ui.add_message({
-                    "type": "message",
-                    "username": message_dict["username"],
-                    "content": message_dict["content"]
-                })
-                # Then encrypt for sending if needed
-                if self.encryption:
-                    message_dict["content"] = self.encryption.encrypt_message(message_dict["content"])
-            message_json = json.dumps(message_dict) + "\n"  # Add newline as message delimiter
-            self.socket.send(message_json.encode('utf-8'))
+            await self.session.send(text)
         except Exception as e:
-            print(f"Failed to send message: {e}")
-            
-    def receive_messages(self):
-        """Continuously receive messages from the server"""
-        buffer = ""
-        while True:
-            try:
-                data = self.socket.recv(4096)
-                if not data:
-                    self.ui.add_message({
-                        "type": "message",
-                        "username": "System",
-                        "content": "Disconnected from server"
-                    })
-                    break
-                    
-                buffer += data.decode('utf-8')
-                
-                # Process complete messages
-                while '\n' in buffer:
-                    message_json, buffer = buffer.split('\n', 1)
-                    try:
-                        message = json.loads(message_json)
-                        # Only process messages that aren't our own
-                        if message.get("username") != self.username:
-                            # Decrypt message content if it's a regular chat message (not a system message)
-                            if (message.get("type") == "message" and 
-                                message.get("username") != "System" and 
-                                self.encryption):
-                                encrypted_content = message.get("content")
-                                if encrypted_content:
-                                    try:
-                                        decrypted_content = self.encryption.decrypt_message(encrypted_content)
-                                        if decrypted_content:
-                                            message["content"] = decrypted_content
-                                        else:
-                                            message["content"] = "[Encrypted message - cannot decrypt]"
-                                    except Exception as e:
-                                        message["content"] = "[Encrypted message - cannot decrypt]"
-                            
-                            self.ui.add_message(message)
-                    except json.JSONDecodeError as e:
-                        # Only show decode errors for non-typing messages (to reduce noise)
-                        if "typing_status" not in message_json:
-                            self.ui.add_message({
-                                "type": "message",
-                                "username": "System",
-                                "content": f"Error decoding message: {e}"
-                            })
-                    except Exception as e:
-                        self.ui.add_message({
-                            "type": "message",
-                            "username": "System",
-                            "content": f"Error processing message: {e}"
-                        })
-            except Exception as e:
-                self.ui.add_message({
-                    "type": "message",
-                    "username": "System",
-                    "content": f"Connection error: {e}"
-                })
-                break
-                
-    def send_typing_status(self, is_typing=True):
+            self.system_message(f"Failed to send message: {e}")
+
+    def system_message(self, content):
+        self.ui.add_message({"type": "message", "username": "System", "content": content})
+
+    async def receive_messages(self):
+        """Hand received messages to the UI until the connection closes"""
+        async for message in self.session:
+            self.ui.add_message(message)
+            self.wake.set()
+
+    def queue_depths(self):
+        """Messages waiting at each receive stage and in the UI"""
+        depths = self.session.queue_depths()
+        depths["ui"] = len(self.ui.message_queue)
+        return depths
+
+    async def join_room(self, args):
+        """Handle /join <room> [password]"""
+        if not args:
+            self.system_message(f"You are in {self.session.room}. "
+                                "Usage: /join <room> [password]")
+            return
+        room, _, password = args.partition(" ")
+        try:
+            await self.session.join(room, password or None)
+        except Exception as e:
+            self.system_message(f"Failed to join {room}: {e}")
+
+    async def send_typing_status(self, is_typing=True):
         """Send typing status to server"""
         try:
-            current_time = time.time()
-            # Always send if state changes to false, otherwise respect rate limit
-            if not is_typing or current_time - self.last_typing_update >= self.typing_update_delay:
-                self.last_typing_update = current_time
-                self.send_message({
-                    "type": "typing_status",
-                    "username": self.username,
-                    "is_typing": is_typing
-                })
+            await self.session.set_typing(is_typing)
         except Exception as e:
             pass  # Ignore typing status errors
-            
-    def start(self):
-        """Start the client application"""
-        if not self.connect():
+
+    async def handle_line(self, message):
+        """Act on an entered line; returns False to quit"""
+        if message.lower() == '/exit':
+            return False
+        if message.lower() == '/queues':
+            depths = ", ".join(f"{k} {v}" for k, v in self.queue_depths().items())
+            self.system_message(f"Queue depths: {depths}")
+        elif message.lower() == '/perf':
+            self.ui.toggle_perf()
+            # Timing runs while the overlay is up, or all along for --perf-dump
+            profiler.enabled = self.ui.perf_overlay or self.perf_dump is not None
+        elif message.lower() == '/who':
+            users = list(self.ui.roster)
+            self.system_message(f"Here: {', '.join(users) if users else 'nobody else'}")
+        elif message.lower() == '/join' or message.lower().startswith('/join '):
+            await self.join_room(message[len('/join'):].strip())
+        else:
+            await self.send_chat(message)
+        return True
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.decrypt_workers))
+        if not await self.connect():
             return
-            
+
+        self.wake = asyncio.Event()
+        self.ui.start()
+        loop.add_reader(sys.stdin.fileno(), self.wake.set)
+        if hasattr(signal, "SIGWINCH"):
+            loop.add_signal_handler(signal.SIGWINCH, self._resized)
+        receiver = asyncio.create_task(self.receive_messages())
         try:
-            # Start UI
-            self.ui.start()
-            
-            # Start receive thread
-            receive_thread = threading.Thread(target=self.receive_messages)
-            receive_thread.daemon = True
-            receive_thread.start()
-            
-            # Main input loop
-            last_typing_state = False
+            last_input = ""
             while True:
-                message = self.ui.get_input()
-                current_typing_state = self.ui.is_typing()
-                
-                # Send typing status only when state changes
-                if current_typing_state != last_typing_state:
-                    self.send_typing_status(current_typing_state)
-                    last_typing_state = current_typing_state
-                
-                if message is not None:
-                    if message.lower() == '/exit':
-                        # Send not typing status before exit
-                        self.send_typing_status(False)
-                        break
-                    self.send_message({
-                        "type": "message",
-                        "username": self.username,
-                        "content": message
-                    })
-                    # Send not typing status after sending message
-                    self.send_typing_status(False)
-                    last_typing_state = False
-                    
-        except KeyboardInterrupt:
-            pass
+                timeout = self.ui.next_wakeup()
+                if timeout != 0:
+                    try:
+                        await asyncio.wait_for(self.wake.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                self.wake.clear()
+
+                lines = self.ui.read_input()
+                # Report typing on keystrokes; the session rate limits
+                # repeats and the server expires us once they stop
+                if self.ui.input_buffer != last_input:
+                    last_input = self.ui.input_buffer
+                    await self.send_typing_status(self.ui.is_typing())
+                for line in lines:
+                    if not await self.handle_line(line):
+                        return
+                self.ui.update()
         finally:
+            receiver.cancel()
+            loop.remove_reader(sys.stdin.fileno())
+            if hasattr(signal, "SIGWINCH"):
+                loop.remove_signal_handler(signal.SIGWINCH)
             # Ensure we send not typing status on exit
-            self.send_typing_status(False)
+            await self.send_typing_status(False)
             self.ui.stop()
-            self.socket.close()
-            
+            await self.session.close()
+            if self.perf_dump is not None:
+                profiler.dump(self.perf_dump)
+                print(f"Timings written to {self.perf_dump}")
+
+    def _resized(self):
+        self.ui.resize()
+        self.wake.set()
+
+    def start(self):
+        """Start the client application"""
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            pass
+
+def benchmark_kdf(budget):
+    """Report cold and cached start-up cost and a calibrated iteration count"""
+    cold = time_derivation(DEFAULT_ITERATIONS)
+    print(f"PBKDF2-SHA256, {DEFAULT_ITERATIONS} iterations: {cold * 1000:.1f} ms (cold start)")
+
+    cache = KeyCache(os.path.join(tempfile.mkdtemp(), "keys.json"))
+    cache.put("benchmark", LEGACY_SALT, DEFAULT_ITERATIONS, os.urandom(32))
+    started = time.perf_counter()
+    MessageEncryption(key=cache.get("benchmark", LEGACY_SALT, DEFAULT_ITERATIONS))
+    warm = time.perf_counter() - started
+    print(f"Key cache hit: {warm * 1000:.2f} ms (with --remember-key)")
+
+    iterations = calibrate_iterations(budget)
+    print(f"Iterations for a {budget:.2f} s budget: {iterations} (server --kdf-iterations)")
+
 if __name__ == "__main__":
-    # Get server address from command line args if provided
-    host = sys.argv[1] if len(sys.argv) > 1 else 'localhost'
-    port = int(sys.argv[2]) if len(sys.argv) > 2 else 9999
-    
-    client = CowtalkClient(host, port)
+    parser = argparse.ArgumentParser(description="cowtalk terminal client")
+    parser.add_argument("host", nargs="?", default="localhost", help="Server address")
+    parser.add_argument("port", nargs="?", type=int, default=9999, help="Server port")
+    parser.add_argument("--room", help="Room to join (default: the server's lobby); /join switches")
+    parser.add_argument("--cowsay-binary", action="store_true",
+                        help="Render with the external cowsay program instead of in-process")
+    parser.add_argument("--fps", type=int, default=30,
+                        help="Maximum screen redraws per second")
+    parser.add_argument("--scrollback", type=int, default=MAX_MESSAGES,
+                        help="Number of messages kept in history (PageUp/PageDown to browse)")
+    parser.add_argument("--framing", choices=[BINARY, LINES], default=BINARY,
+                        help="Wire format to ask the server for; falls back to json")
+    parser.add_argument("--compress", action="store_true",
+                        help="Ask the server to compress what it sends (for slow links)")
+    parser.add_argument("--decrypt-workers", type=int, default=DECRYPT_WORKERS,
+                        help="Threads decrypting received messages (type /queues to see backlog)")
+    parser.add_argument("--remember-key", action="store_true",
+                        help="Cache the derived room key on disk and skip the password next time")
+    parser.add_argument("--forget-key", action="store_true",
+                        help="Drop the cached key for this room and ask for the password")
+    parser.add_argument("--no-reconnect", action="store_true",
+                        help="Stop when the connection drops instead of reconnecting")
+    parser.add_argument("--perf-dump", metavar="FILE",
+                        help="Time cowsay, decryption and repaints all session and write "
+                             "the histograms to FILE as JSON on exit (/perf shows them live)")
+    parser.add_argument("--benchmark-kdf", action="store_true",
+                        help="Measure key derivation cost and suggest an iteration count, then exit")
+    parser.add_argument("--kdf-budget", type=float, default=0.5,
+                        help="Target seconds per key derivation for --benchmark-kdf")
+    args = parser.parse_args()
+
+    if args.benchmark_kdf:
+        benchmark_kdf(args.kdf_budget)
+        sys.exit(0)
+
+    key_cache = KeyCache() if args.remember_key or args.forget_key else None
+    client = CowtalkClient(args.host, args.port, use_cowsay_binary=args.cowsay_binary,
+                           frame_rate=args.fps, scrollback=args.scrollback,
+                           framing=args.framing, key_cache=key_cache,
+                           forget_key=args.forget_key, decrypt_workers=args.decrypt_workers,
+                           room=args.room, reconnect=not args.no_reconnect,
+                           compress=args.compress, perf_dump=args.perf_dump)
     client.start()
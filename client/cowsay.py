@@ -0,0 +1,65 @@
+import subprocess
+import textwrap
+from functools import lru_cache
+
+DEFAULT_WIDTH = 40   # Same as `cowsay -W 40`, the cowsay default
+CACHE_SIZE = 2048    # Rendered bubbles kept around for reuse
+
+COW = (
+    "        \\   ^__^",
+    "         \\  (oo)\\_______",
+    "            (__)\\       )\\/\\",
+    "                ||----w |",
+    "                ||     ||",
+)
+
+def _wrap(text, width):
+    """Word-wrap text like cowsay does (Text::Wrap fill with -W width)"""
+    # cowsay collapses all whitespace and never breaks on hyphens
+    words = " ".join(text.split())
+    lines = textwrap.wrap(
+        words,
+        width=max(width - 1, 1),
+        break_long_words=True,
+        break_on_hyphens=False
+    )
+    return lines or [""]
+
+def _bubble(lines):
+    """Draw the speech bubble around already wrapped lines"""
+    longest = max(len(line) for line in lines)
+    bubble = [" " + "_" * (longest + 2)]
+    if len(lines) == 1:
+        bubble.append(f"< {lines[0]} >")
+    else:
+        last = len(lines) - 1
+        for i, line in enumerate(lines):
+            if i == 0:
+                left, right = "/", "\\"
+            elif i == last:
+                left, right = "\\", "/"
+            else:
+                left, right = "|", "|"
+            bubble.append(f"{left} {line.ljust(longest)} {right}")
+    bubble.append(" " + "-" * (longest + 2))
+    return bubble
+
+@lru_cache(maxsize=CACHE_SIZE)
+def render(text, width=DEFAULT_WIDTH):
+    """Render text as cowsay output, returned as a tuple of lines.
+
+    The trailing empty line matches splitting cowsay's stdout on newlines.
+    """
+    return tuple(_bubble(_wrap(text, width))) + COW + ("",)
+
+def render_subprocess(text, width=DEFAULT_WIDTH):
+    """Render by running the real cowsay binary, falling back to render()"""
+    try:
+        result = subprocess.run(
+            ["cowsay", "-W", str(width), text],
+            capture_output=True,
+            text=True
+        )
+        return tuple(result.stdout.split('\n'))
+    except FileNotFoundError:
+        return render(text, width)
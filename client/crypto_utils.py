@@ -1,30 +1,161 @@
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import base64
+import json
 import os
+import time
+
+LEGACY_SALT = b'cowtalk_static_salt'  # Used with servers that don't hand out room salts
+DEFAULT_ITERATIONS = 100000
+FERNET = "fernet"                        # Base64 tokens; AES-CBC + HMAC
+AES_GCM = "aes-gcm"                      # Raw nonce + ciphertext + tag
+CHACHA20_POLY1305 = "chacha20-poly1305"  # Same layout as AES-GCM
+AEAD_CIPHERS = {AES_GCM: AESGCM, CHACHA20_POLY1305: ChaCha20Poly1305}
+NONCE_SIZE = 12
+KEY_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "cowtalk", "keys.json")
+
+def derive_key(password, salt, iterations=DEFAULT_ITERATIONS):
+    """Derive a 32-byte key from a password using PBKDF2"""
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        iterations=iterations,
+    )
+    return kdf.derive(password.encode())
+
+def time_derivation(iterations, rounds=3):
+    """Fastest of a few key derivations, in seconds"""
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        derive_key("calibration", os.urandom(16), iterations)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def calibrate_iterations(budget, sample=20000):
+    """PBKDF2 iteration count that takes about budget seconds on this machine"""
+    per_iteration = time_derivation(sample) / sample
+    return max(int(budget / per_iteration) // 1000 * 1000, 1000)
+
+class KeyCache:
+    """Derived keys on disk, so returning users skip PBKDF2 and the password.
+
+    Entries are keyed by server/room, salt and iteration count, so a room
+    that gets a new salt simply misses the cache. The file holds raw keys
+    and is only ever readable by the current user.
+    """
+
+    def __init__(self, path=KEY_CACHE_PATH):
+        self.path = path
+
+    def _entry(self, room, salt, iterations):
+        return f"{room}/{base64.b64encode(salt).decode()}/{iterations}"
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, entries):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        temp_path = self.path + ".tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(entries, f)
+        os.replace(temp_path, self.path)
+
+    def get(self, room, salt, iterations):
+        key = self._load().get(self._entry(room, salt, iterations))
+        return base64.b64decode(key) if key else None
+
+    def put(self, room, salt, iterations, key):
+        entries = self._load()
+        entries[self._entry(room, salt, iterations)] = base64.b64encode(key).decode()
+        self._save(entries)
+
+    def forget(self, room):
+        """Drop every cached key for a room"""
+        entries = self._load()
+        prefix = room + "/"
+        remaining = {k: v for k, v in entries.items() if not k.startswith(prefix)}
+        if len(remaining) != len(entries):
+            self._save(remaining)
 
 class MessageEncryption:
-    def __init__(self, password):
-        """Initialize encryption with a password"""
-        # Generate a key from the password using PBKDF2
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=b'cowtalk_static_salt',  # In production, use a unique salt per user
-            iterations=100000,
-        )
-        key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
-        self.fernet = Fernet(key)
+    """Encrypts chat messages with a room's key.
+
+    With Fernet, ciphertexts are base64 strings. The AEAD ciphers produce
+    raw bytes (a random 12-byte nonce followed by ciphertext and tag), which
+    go out as-is in binary frames and skip the base64 and HMAC overhead.
+    """
+
+    def __init__(self, password=None, salt=LEGACY_SALT, iterations=DEFAULT_ITERATIONS, key=None,
+                 cipher=FERNET):
+        """Initialize encryption with a password, or an already derived key"""
+        if key is None:
+            # Generate a key from the password using PBKDF2
+            key = derive_key(password, salt, iterations)
+        self.key = key
+        self.cipher = cipher
+        if cipher == FERNET:
+            self.fernet = Fernet(base64.urlsafe_b64encode(key))
+        elif cipher in AEAD_CIPHERS:
+            self.aead = AEAD_CIPHERS[cipher](key)
+        else:
+            raise ValueError(f"Unknown cipher {cipher}")
 
     def encrypt_message(self, message):
         """Encrypt a message"""
-        return self.fernet.encrypt(message.encode()).decode()
+        if self.cipher == FERNET:
+            return self.fernet.encrypt(message.encode()).decode()
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self.aead.encrypt(nonce, message.encode(), None)
 
     def decrypt_message(self, encrypted_message):
-        """Decrypt a message"""
+        """Decrypt a message, or return None if it can't be"""
         try:
-            return self.fernet.decrypt(encrypted_message.encode()).decode()
+            if isinstance(encrypted_message, str):
+                encrypted_message = encrypted_message.encode()
+            if self.cipher == FERNET:
+                return self.fernet.decrypt(encrypted_message).decode()
+            nonce = encrypted_message[:NONCE_SIZE]
+            return self.aead.decrypt(nonce, encrypted_message[NONCE_SIZE:], None).decode()
         except Exception as e:
             # print(f"Failed to decrypt message: {e}")
-            return None 
\ No newline at end of file
+            return None
+
+    def encrypt_many(self, messages):
+        """Encrypt a batch of messages, in order"""
+        if self.cipher == FERNET:
+            return [self.encrypt_message(message) for message in messages]
+        # One urandom call for the whole batch instead of one per message
+        nonces = memoryview(os.urandom(NONCE_SIZE * len(messages)))
+        encrypt = self.aead.encrypt
+        results = []
+        for i, message in enumerate(messages):
+            nonce = bytes(nonces[i * NONCE_SIZE:(i + 1) * NONCE_SIZE])
+            results.append(nonce + encrypt(nonce, message.encode(), None))
+        return results
+
+    def decrypt_many(self, encrypted_messages):
+        """Decrypt a batch of messages; entries that fail come back as None"""
+        if self.cipher == FERNET:
+            return [self.decrypt_message(message) for message in encrypted_messages]
+        decrypt = self.aead.decrypt
+        results = []
+        for message in encrypted_messages:
+            try:
+                if isinstance(message, str):
+                    message = message.encode()
+                view = memoryview(message)
+                results.append(decrypt(view[:NONCE_SIZE], view[NONCE_SIZE:], None).decode())
+            except Exception:
+                results.append(None)
+        return results
@@ -0,0 +1,107 @@
+import bisect
+import json
+import threading
+import time
+
+# Timing hooks for the client's hot paths. Code that wants to be measured
+# does
+#
+#     started = time.perf_counter() if profiler.enabled else None
+#     ...
+#     if started is not None:
+#         profiler.observe("stage", time.perf_counter() - started)
+#
+# so while profiling is off a hook costs one attribute test.
+
+# Bucket bounds in seconds, about 26% apart from 1 µs to 10 s
+BOUNDS = [10 ** (exponent / 10) / 1e6 for exponent in range(71)]
+
+class Histogram:
+    """Counts of durations in fixed log-spaced buckets"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)  # The last one is everything slower
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds, count=1):
+        self.counts[bisect.bisect_left(BOUNDS, seconds)] += count
+        self.count += count
+        self.total += seconds * count
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding that fraction of observations"""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BOUNDS[i] if i < len(BOUNDS) else self.max
+        return self.max
+
+    def summary(self):
+        ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+        return {
+            "count": self.count,
+            "p50_ms": ms(self.percentile(0.50)),
+            "p99_ms": ms(self.percentile(0.99)),
+            "mean_ms": ms(self.total / self.count) if self.count else None,
+            "max_ms": ms(self.max),
+        }
+
+class Profiler:
+    """Per-stage timing histograms and event counters.
+
+    Stages may be timed from decryption threads, so updates take a lock;
+    they only happen while enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.started = time.monotonic()
+        self.stages = {}    # Name -> Histogram
+        self.counters = {}  # Name -> running total
+        self.lock = threading.Lock()
+        self.last_rates = (self.started, {})  # What rates() compared against last time
+
+    def observe(self, stage, seconds, count=1):
+        """Record count occurrences of a stage that took seconds each"""
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds, count)
+
+    def add(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def rates(self):
+        """Per-second rate of every counter since the previous call"""
+        now = time.monotonic()
+        with self.lock:
+            counters = dict(self.counters)
+        then, previous = self.last_rates
+        self.last_rates = (now, counters)
+        elapsed = max(now - then, 1e-9)
+        return {name: (value - previous.get(name, 0)) / elapsed
+                for name, value in counters.items()}
+
+    def summary(self):
+        with self.lock:
+            return {
+                "seconds": round(time.monotonic() - self.started, 3),
+                "stages": {name: h.summary() for name, h in self.stages.items()},
+                "counters": dict(self.counters),
+            }
+
+    def dump(self, path):
+        """Write the summary as JSON"""
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+profiler = Profiler()  # Shared by the UI and the session
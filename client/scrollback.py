@@ -0,0 +1,119 @@
+from collections import OrderedDict, namedtuple
+
+MAX_MESSAGES = 100000     # Raw messages kept in the ring buffer
+RENDER_CACHE_SIZE = 512   # Rendered messages kept per width
+
+ChatMessage = namedtuple("ChatMessage", "timestamp sender content")
+
+class Scrollback:
+    """Ring buffer of raw chat messages with lazily rendered lines.
+
+    Every message gets a sequence number when it is appended. Lines are only
+    rendered when a message is needed for the viewport, and a bounded LRU
+    keyed on (seq, width) keeps memory proportional to the raw text.
+
+    A viewport position is an anchor (seq, skip): the bottom screen row shows
+    the message seq with its last skip lines cut off. None follows the tail.
+    """
+
+    def __init__(self, render, capacity=MAX_MESSAGES, cache_size=RENDER_CACHE_SIZE):
+        self.render = render  # render(message, width) -> list of lines
+        self.capacity = capacity
+        self.items = [None] * capacity
+        self.end_seq = 0  # Sequence number the next message will get
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+    def __len__(self):
+        return self.end_seq - self.first_seq
+
+    @property
+    def first_seq(self):
+        """Sequence number of the oldest message still stored"""
+        return max(self.end_seq - self.capacity, 0)
+
+    def append(self, message):
+        """Store a message, evicting the oldest once full; O(1)"""
+        self.items[self.end_seq % self.capacity] = message
+        self.end_seq += 1
+
+    def get(self, seq):
+        return self.items[seq % self.capacity]
+
+    def lines(self, seq, width):
+        """Rendered lines for message seq at the given width"""
+        key = (seq, width)
+        lines = self.cache.get(key)
+        if lines is None:
+            lines = self.render(self.get(seq), width)
+            self.cache[key] = lines
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(key)
+        return lines
+
+    def visible_lines(self, anchor, width, height):
+        """Up to height lines ending at anchor, oldest first"""
+        if not len(self):
+            return []
+        if anchor is None:
+            seq, skip = self.end_seq - 1, 0
+        else:
+            seq, skip = anchor
+            if seq < self.first_seq:
+                seq, skip = self.first_seq, 0
+
+        chunks = []
+        count = 0
+        while seq >= self.first_seq and count < height:
+            lines = self.lines(seq, width)
+            end = max(len(lines) - skip, 1)  # Widths can change under an anchor
+            start = max(end - (height - count), 0)
+            chunks.append(lines[start:end])
+            count += end - start
+            skip = 0
+            seq -= 1
+
+        visible = []
+        for chunk in reversed(chunks):
+            visible.extend(chunk)
+        return visible
+
+    def top_anchor(self, width, height):
+        """Anchor that shows the oldest message at the top, or None if all fits"""
+        total = 0
+        for seq in range(self.first_seq, self.end_seq):
+            count = len(self.lines(seq, width))
+            if total + count >= height:
+                return (seq, total + count - height)
+            total += count
+        return None
+
+    def scroll(self, anchor, delta, width, height):
+        """Move an anchor by delta lines; positive scrolls back into history"""
+        if not len(self):
+            return None
+        seq, skip = anchor if anchor is not None else (self.end_seq - 1, 0)
+        skip += delta
+
+        if delta > 0:
+            while seq >= self.first_seq and skip >= len(self.lines(seq, width)):
+                skip -= len(self.lines(seq, width))
+                seq -= 1
+            # Don't scroll past the first screenful of history
+            top = self.top_anchor(width, height)
+            if top is None:
+                return None
+            if seq < self.first_seq or (seq, -skip) < (top[0], -top[1]):
+                return top
+            return (seq, skip)
+
+        while skip < 0:
+            seq += 1
+            if seq >= self.end_seq:
+                return None
+            skip += len(self.lines(seq, width))
+        if seq == self.end_seq - 1 and skip == 0:
+            return None  # Back at the bottom, follow new messages again
+        return (seq, skip)
@@ -1,32 +1,73 @@
 import curses
-import subprocess
+from collections import deque
 from datetime import datetime
-import threading
-from queue import Queue
-import textwrap
+import os
+import sys
 import time
+import cowsay
+from perf import profiler
+from scrollback import Scrollback, ChatMessage, MAX_MESSAGES
+
+TIMESTAMP_WIDTH = len("[00:00:00] ")
+INPUT_HEIGHT = 2           # Prompt row plus a spare row below it
+PERF_INTERVAL = 1.0        # Seconds between updates of the /perf overlay
+PERF_STAGES = ("cowsay", "decrypt", "repaint")
+
+def name_list(users, shown=2):
+    """A few names and a count of the rest: alice, bob and 40 others"""
+    if len(users) > shown + 1:
+        return f"{', '.join(users[:shown])} and {len(users) - shown} others"
+    if len(users) > 1:
+        return f"{', '.join(users[:-1])} and {users[-1]}"
+    return users[0] if users else "nobody else"
 
 class ChatUI:
-    def __init__(self):
+    """Curses chat screen, driven by one event loop.
+
+    Nothing here blocks or runs on its own thread: the owner feeds it
+    messages with add_message(), calls read_input() when stdin is readable
+    and resize() on SIGWINCH, and calls update() after each wakeup. It
+    sleeps until input arrives or next_wakeup() says a frame or a typing
+    expiry is due, so an idle client uses no CPU.
+    """
+
+    def __init__(self, use_cowsay_binary=False, frame_rate=30, max_messages=MAX_MESSAGES):
         self.screen = None
         self.input_buffer = ""
         self.cursor_x = 0
-        self.message_queue = Queue()
-        self.messages = []
-        self.max_messages = 100  # Keep last 100 messages in history
-        self.input_pad = None
-        self.messages_pad = None
+        self.message_queue = deque()  # Received messages not yet applied
+        # Raw message history; lines are rendered only when scrolled into view
+        self.messages = Scrollback(self._render_message, capacity=max_messages)
+        self.scroll_anchor = None  # None follows the newest message
+        self.messages_win = None
+        self.typing_win = None
+        self.input_win = None
+        self.key_win = None
         self.last_height = 0
         self.last_width = 0
-        self.needs_resize = False
-        self.needs_message_refresh = False
-        self.last_message_count = 0
         self.last_message_time = 0
         self.message_delay = 0.5  # 500ms delay between messages
-        self.typing_users = {}  # Track who is typing
+        self.typing_users = {}  # Who is typing -> last update, or None if the server expires them
+        self.roster = {}  # Who is in the room, in the order they arrived (a dict as an ordered set)
+        self.typing_lines = []  # Lines currently drawn in the typing region
         self.last_input_time = 0
-        self.typing_timeout = 0.5  # Reduce timeout to 500ms
-        
+        self.typing_timeout = 1.5  # For servers that relay typing_status; refreshed every second
+        self.use_cowsay_binary = use_cowsay_binary  # Fork the real cowsay instead of rendering in-process
+        self.frame_rate = frame_rate  # Upper bound on redraws per second
+
+        # Damage tracking: input and messages record what changed, update()
+        # turns it into at most one doupdate() per frame
+        self.damage = set()  # Regions to repaint: "all", "messages", "typing", "input", "perf"
+        self.new_messages = 0  # Messages appended since the last frame
+        self.last_frame = 0  # time.monotonic() of the last frame drawn
+        self.running = False
+
+        # The /perf overlay, drawn over the top right of the message area
+        self.perf_overlay = False
+        self.perf_lines = []
+        self.perf_due = 0  # time.monotonic() of its next update
+        self.perf_queue_max = 0  # Deepest message_queue since the last update
+
     def start(self):
         """Initialize and start the UI"""
         self.screen = curses.initscr()
@@ -38,279 +79,460 @@ class ChatUI:
         curses.cbreak()
         curses.curs_set(1)  # Show cursor
         self.screen.keypad(True)
-        
-        # Enable terminal buffering with shorter delay
-        curses.halfdelay(1)  # 100ms input timeout
-        
-        # Initialize pads
+
+        # Keys are read from a 1x1 window we never draw into, so getch()
+        # never triggers a refresh of its own. It doesn't wait either:
+        # read_input() is only called once stdin is readable.
+        self.key_win = curses.newwin(1, 1, 0, 0)
+        self.key_win.keypad(True)
+        self.key_win.nodelay(True)
+        self.key_win.noutrefresh()
+
         height, width = self.screen.getmaxyx()
         self.last_height = height
         self.last_width = width
-        self._init_pads()
-        
+        self.running = True
+
         # Draw initial screen
         self.refresh_screen(force=True)
-        
-        # Start message processing thread
-        self.processor = threading.Thread(target=self._process_messages)
-        self.processor.daemon = True
-        self.processor.start()
-        
-    def _init_pads(self):
-        """Initialize or reinitialize the pads"""
+        self.last_frame = time.monotonic()
+
+    def _init_windows(self):
+        """Lay out the message, typing and input windows for the current size"""
         height, width = self.screen.getmaxyx()
-        # Message pad with room for lots of scrollback
-        self.messages_pad = curses.newpad(1000, width)
-        # Input pad for the bottom area
-        self.input_pad = curses.newpad(2, width)
-        
+        area_height = max(height - INPUT_HEIGHT - 1, 1)
+        typing_height = min(len(self.typing_lines), area_height - 1)
+        message_height = area_height - typing_height
+
+        self.messages_win = curses.newwin(message_height, width, 0, 0)
+        self.messages_win.scrollok(True)  # Needed for scroll() on new messages
+        self.messages_win.idlok(True)  # Let curses use the terminal's own scrolling
+        self.typing_win = None
+        if typing_height > 0:
+            self.typing_win = curses.newwin(typing_height, width, message_height, 0)
+        self.input_win = curses.newwin(INPUT_HEIGHT + 1, width, area_height, 0)
+
     def stop(self):
         """Clean up and restore terminal"""
+        self.running = False
         curses.nocbreak()
         self.screen.keypad(False)
         curses.echo()
         curses.endwin()
-        
-    def _get_cowsay(self, text):
+
+    def _bubble_width(self, width):
+        """Wrap column that keeps a timestamped cowsay bubble on screen"""
+        # Leave room for the bubble borders and the timestamp prefix
+        return max(width - TIMESTAMP_WIDTH - 4, 10)
+
+    def _get_cowsay(self, text, width=None):
         """Get cowsay output for text"""
-        try:
-            result = subprocess.run(
-                ["cowsay", text],
-                capture_output=True,
-                text=True
-            )
-            return result.stdout.split('\n')
-        except FileNotFoundError:
-            return text.split('\n')
-            
+        bubble_width = self._bubble_width(width or self.last_width)
+        started = time.perf_counter() if profiler.enabled else None
+        if self.use_cowsay_binary:
+            lines = cowsay.render_subprocess(text, bubble_width)
+        else:
+            lines = cowsay.render(text, bubble_width)
+        if started is not None:
+            profiler.observe("cowsay", time.perf_counter() - started)
+        return list(lines)  # Rendered lines are cached, hand out a copy
+
     def is_typing(self):
         """Check if the user is currently typing"""
         # Only consider typing if there are actual characters in the buffer
         return len(self.input_buffer.strip()) > 0
-        
+
     def _get_typing_indicator(self, username):
         """Get cowsay typing indicator"""
-        try:
-            result = subprocess.run(
-                ["cowsay", f"{username} is typing..."],
-                capture_output=True,
-                text=True
-            )
-            return result.stdout.split('\n')
-        except FileNotFoundError:
-            return [f"{username} is typing..."]
-            
+        # Cache hit after the first render for each typing user
+        return self._get_cowsay(f"{username} is typing...")
+
+    def _render_message(self, message, width):
+        """Render one chat message into cowsay lines"""
+        cowsay_lines = self._get_cowsay(f"{message.sender}: {message.content}", width)
+        # Add timestamp to first line
+        cowsay_lines[0] = f"[{message.timestamp}] " + cowsay_lines[0]
+        return cowsay_lines
+
     def _process_messages(self):
-        """Process messages from queue and update display"""
-        while True:
+        """Apply queued messages and record what needs redrawing"""
+        if self.perf_overlay:
+            self.perf_queue_max = max(self.perf_queue_max, len(self.message_queue))
+        while self.message_queue:
+            message = self.message_queue.popleft()
             try:
-                message = self.message_queue.get()
-                if message is None:
-                    break
-                    
+                if message.get("type") == "typing":
+                    # A snapshot of everyone typing in the room; the server
+                    # expires them and sends a new one when it changes.
+                    # The renderer diffs the typing region and only repaints it
+                    self.typing_users = dict.fromkeys(message.get("users", []))
+                    continue
+
                 if message.get("type") == "typing_status":
                     username = message.get("username")
-                    is_typing = message.get("is_typing", False)
-                    if is_typing:
+                    if message.get("is_typing", False):
                         self.typing_users[username] = time.time()
                     else:
                         self.typing_users.pop(username, None)
-                    self.needs_message_refresh = True
-                    self.refresh_screen()
                     continue
-                    
-                timestamp = datetime.now().strftime("%H:%M:%S")
+
+                if message.get("type") == "roster":
+                    content = self._apply_roster(message)
+                    if content:
+                        self._append("System", content)
+                    continue
+
                 sender = message.get("username", "Anonymous")
                 content = message.get("content", "")
-                
+
                 # Remove typing indicator if user sends a message
                 self.typing_users.pop(sender, None)
-                
-                # Format message with timestamp
-                formatted = f"{sender}: {content}"
-                cowsay_lines = self._get_cowsay(formatted)
-                
-                # Add timestamp to first line
-                cowsay_lines[0] = f"[{timestamp}] " + cowsay_lines[0]
-                
-                self.messages.append({
-                    "timestamp": timestamp,
-                    "sender": sender,
-                    "content": content,
-                    "lines": cowsay_lines
-                })
-                
-                # Keep only last max_messages
-                if len(self.messages) > self.max_messages:
-                    self.messages.pop(0)
-                    
-                self.needs_message_refresh = True
-                self.refresh_screen()
-            except:
+                self._append(sender, content)
+            except Exception:
                 pass  # Ignore any errors in message processing
-            
+
+    def _append(self, sender, content):
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        # Rendering is left to the renderer, and only if it's visible
+        self.messages.append(ChatMessage(timestamp, sender, content))
+        self.new_messages += 1
+
+    def _apply_roster(self, message):
+        """Update who is in the room; returns the line to show, if any.
+
+        A snapshot ("users") arrives when we enter a room, deltas
+        ("joined"/"left") batch everyone who came and went since the
+        server's last roster tick, so a reconnect storm is one line.
+        """
+        if "users" in message:
+            self.roster = dict.fromkeys(message["users"])
+            return f"Here: {name_list(message['users'])}"
+        joined = message.get("joined", [])
+        left = message.get("left", [])
+        self.roster.update(dict.fromkeys(joined))
+        for username in left:
+            self.roster.pop(username, None)
+        parts = []
+        if joined:
+            parts.append(f"{name_list(joined)} joined")
+        if left:
+            parts.append(f"{name_list(left)} left")
+        return "; ".join(parts)
+
     def add_message(self, message):
-        """Add a message to the display queue"""
-        self.message_queue.put(message)
-        
-    def get_input(self):
-        """Get input from user"""
+        """Add a message to the display queue; it's applied on the next update()"""
+        self.message_queue.append(message)
+
+    def toggle_perf(self):
+        """Show or hide the /perf overlay"""
+        self.perf_overlay = not self.perf_overlay
+        if self.perf_overlay:
+            profiler.rates()  # Rates shown are from now on
+            self.perf_lines = ["measuring..."]
+            self.perf_due = time.monotonic() + PERF_INTERVAL
+            self.perf_queue_max = len(self.message_queue)
+            self._invalidate("perf")
+        else:
+            self._invalidate("messages")  # Uncover what was under it
+
+    def _perf_text(self):
+        """The overlay's lines: per-stage timings, then the rates"""
+        stages = profiler.summary()["stages"]
+        rates = profiler.rates()
+        lines = [f"{'stage':<8}{'p50 ms':>9}{'p99 ms':>9}{'count':>8}"]
+        for name in PERF_STAGES:
+            stage = stages.get(name)
+            if stage is None:
+                lines.append(f"{name:<8}{'-':>9}{'-':>9}{0:>8}")
+            else:
+                lines.append(f"{name:<8}{stage['p50_ms']:>9.3f}{stage['p99_ms']:>9.3f}"
+                             f"{stage['count']:>8}")
+        lines.append(f"fps {rates.get('frames', 0):.1f}  queue {len(self.message_queue)} "
+                     f"(max {self.perf_queue_max})")
+        lines.append(f"rx {rates.get('net_rx_bytes', 0) / 1024:.1f} KB/s")
+        self.perf_queue_max = len(self.message_queue)
+        return lines
+
+    def _invalidate(self, region):
+        """Mark a region as needing a repaint"""
+        self.damage.add(region)
+
+    def _scroll(self, pages):
+        """Scroll the message history by whole pages; positive goes back"""
+        if self.messages_win is None:
+            return
+        height, width = self.messages_win.getmaxyx()
+        page = max(height - 1, 1)  # Keep one line of context
+        self.scroll_anchor = self.messages.scroll(
+            self.scroll_anchor, pages * page, width, height)
+        self.damage.update(("messages", "input"))
+
+    def resize(self):
+        """Adopt the terminal's new size (call on SIGWINCH)"""
         try:
-            ch = self.screen.getch()
-        except curses.error:
-            return None  # No input available
-            
-        # Check for terminal resize
+            size = os.get_terminal_size(sys.__stdout__.fileno())
+            curses.resizeterm(size.lines, size.columns)
+        except (OSError, curses.error):
+            pass
+        self._check_size()
+
+    def _check_size(self):
         height, width = self.screen.getmaxyx()
         if height != self.last_height or width != self.last_width:
             self.last_height = height
             self.last_width = width
-            self.needs_resize = True
-            self._init_pads()
-            self.refresh_screen(force=True)
-            return None
-            
+            # Messages are re-rendered lazily at the new width
+            self._invalidate("all")
+
+    def read_input(self):
+        """Handle every key waiting on stdin; returns the lines entered"""
+        lines = []
+        while True:
+            try:
+                ch = self.key_win.getch()
+            except curses.error:
+                break
+            if ch == -1:
+                break  # Nothing more buffered
+            if ch == curses.KEY_RESIZE:
+                # Queued by resizeterm(), or by curses' own SIGWINCH handler
+                self._check_size()
+                continue
+            line = self._handle_key(ch)
+            if line is not None:
+                lines.append(line)
+        return lines
+
+    def _handle_key(self, ch):
+        """Edit the input line for one key; returns a line when Enter sends one"""
         if ch == curses.KEY_BACKSPACE or ch == 127:
             if self.cursor_x > 0:
                 self.input_buffer = (
-                    self.input_buffer[:self.cursor_x-1] + 
+                    self.input_buffer[:self.cursor_x-1] +
                     self.input_buffer[self.cursor_x:]
                 )
                 self.cursor_x -= 1
-                self._refresh_input()
+                self._invalidate("input")
         elif ch == curses.KEY_LEFT:
             if self.cursor_x > 0:
                 self.cursor_x -= 1
-                self._refresh_input()
+                self._invalidate("input")
         elif ch == curses.KEY_RIGHT:
             if self.cursor_x < len(self.input_buffer):
                 self.cursor_x += 1
-                self._refresh_input()
+                self._invalidate("input")
+        elif ch == curses.KEY_PPAGE:
+            self._scroll(1)
+        elif ch == curses.KEY_NPAGE:
+            self._scroll(-1)
         elif ch == 10:  # Enter key
             # Check if enough time has passed since last message
             current_time = time.time()
             if current_time - self.last_message_time < self.message_delay:
                 # If not enough time has passed, ignore this message
                 return None
-                
+
             message = self.input_buffer
             if message.strip():  # Only send non-empty messages
                 self.last_message_time = current_time
                 self.input_buffer = ""
                 self.cursor_x = 0
-                self._refresh_input()
+                self._invalidate("input")
                 return message
             else:
                 # Clear empty message without updating last_message_time
                 self.input_buffer = ""
                 self.cursor_x = 0
-                self._refresh_input()
+                self._invalidate("input")
         elif ch >= 32 and ch < 127:  # Printable characters
             self.input_buffer = (
-                self.input_buffer[:self.cursor_x] + 
-                chr(ch) + 
+                self.input_buffer[:self.cursor_x] +
+                chr(ch) +
                 self.input_buffer[self.cursor_x:]
             )
             self.cursor_x += 1
-            self._refresh_input()
-            
-        if self.needs_resize or self.needs_message_refresh:
-            self.refresh_screen()
-            
+            self._invalidate("input")
+
         return None
-        
-    def _refresh_input(self):
-        """Refresh just the input area"""
-        height, width = self.screen.getmaxyx()
-        input_height = 2
-        self.input_pad.erase()
+
+    def update(self):
+        """Apply received messages and draw a frame if anything changed,
+        at most frame_rate times per second
+        """
+        self._process_messages()
+        if time.monotonic() - self.last_frame < 1.0 / self.frame_rate:
+            return  # Folded into the frame next_wakeup() asks for
+        if self.refresh_screen():
+            self.last_frame = time.monotonic()
+
+    def next_wakeup(self):
+        """Seconds until update() has work without new input: a frame held
+        back by the frame rate, or a typing indicator timing out. None if
+        nothing is due, so the caller can sleep until input arrives.
+        """
+        deadlines = []
+        if self.damage or self.new_messages or self.message_queue:
+            deadlines.append(self.last_frame + 1.0 / self.frame_rate - time.monotonic())
+        if self.perf_overlay:
+            deadlines.append(self.perf_due - time.monotonic())
+        expiry = self._next_typing_expiry()
+        if expiry is not None:
+            deadlines.append(expiry)
+        return max(min(deadlines), 0) if deadlines else None
+
+    def _next_typing_expiry(self):
+        """Seconds until the oldest typing indicator times out, or None"""
+        updates = [t for t in self.typing_users.values() if t is not None]
+        if not updates:
+            return None
+        oldest = min(updates)
+        return max(oldest + self.typing_timeout - time.time(), 0) + 0.01
+
+    def _current_typing_lines(self):
+        """Cowsay lines for everyone still typing; expires stale entries"""
+        current_time = time.time()
+        lines = []
+        for username, last_time in list(self.typing_users.items()):
+            # Remove typing status if too old
+            if last_time is not None and current_time - last_time > self.typing_timeout:
+                del self.typing_users[username]
+                continue
+            lines.extend(self._get_typing_indicator(username))
+        return lines
+
+    def _draw_lines(self, win, lines, first_row):
+        """Draw lines into win starting at first_row, clipped to its width"""
+        width = win.getmaxyx()[1]
+        for row, line in enumerate(lines, first_row):
+            try:
+                win.addstr(row, 0, line[:width-1])
+            except curses.error:
+                pass
+
+    def _count_new_lines(self, new_messages, width, limit):
+        """Lines taken up by the newest messages, stopping once past limit"""
+        count = 0
+        seq = self.messages.end_seq - 1
+        for _ in range(min(new_messages, len(self.messages))):
+            count += len(self.messages.lines(seq, width))
+            if count >= limit:
+                break
+            seq -= 1
+        return count
+
+    def _draw_messages(self, new_messages):
+        """Scroll in new messages, or repaint the whole message area"""
+        height, width = self.messages_win.getmaxyx()
+        new_lines = None
+        if new_messages is not None:
+            new_lines = self._count_new_lines(new_messages, width, height)
+        if new_lines is None or new_lines >= height:
+            # Full repaint, bottom-aligned just above the typing region
+            visible = self.messages.visible_lines(self.scroll_anchor, width, height)
+            self.messages_win.erase()
+            self._draw_lines(self.messages_win, visible, height - len(visible))
+        else:
+            # Shift what's already on screen and paint only the new lines
+            self.messages_win.scroll(new_lines)
+            visible = self.messages.visible_lines(None, width, new_lines)
+            self._draw_lines(self.messages_win, visible, height - new_lines)
+        self.messages_win.noutrefresh()
+
+    def _draw_perf(self):
+        """Draw the overlay on top of the message area"""
+        height, width = self.messages_win.getmaxyx()
+        top, left = self.messages_win.getbegyx()
+        lines = self.perf_lines[:height]
+        overlay_width = min(max(map(len, lines)) + 2, width)
+        win = curses.newwin(len(lines), overlay_width, top, left + width - overlay_width)
+        win.erase()
+        self._draw_lines(win, [" " + line for line in lines], 0)
+        win.noutrefresh()
+
+    def _draw_typing(self):
+        """Repaint the typing-indicator region"""
+        if self.typing_win is None:
+            return
+        height = self.typing_win.getmaxyx()[0]
+        self.typing_win.erase()
+        self._draw_lines(self.typing_win, self.typing_lines[:height], 0)
+        self.typing_win.noutrefresh()
+
+    def _draw_input(self):
+        """Repaint the separator and input line"""
+        width = self.input_win.getmaxyx()[1]
         prompt = "Message: "
+        self.input_win.erase()
         try:
-            # Clear the entire input line first
-            self.screen.move(height - 2, 0)
-            self.screen.clrtoeol()
             # Draw separator line
-            self.screen.move(height - input_height - 1, 0)
-            self.screen.clrtoeol()
-            self.screen.addstr(height - input_height - 1, 0, "-" * (width - 1))
+            separator = "-" * (width - 1)
+            if self.scroll_anchor is not None:
+                hint = "- scrolled back, PgDn for newer messages "
+                separator = (hint + separator)[:width - 1]
+            self.input_win.addstr(0, 0, separator)
             # Now add our input content
-            self.screen.addstr(height - 2, 0, prompt + self.input_buffer)
+            self.input_win.addstr(1, 0, (prompt + self.input_buffer)[:width-1])
             # Position cursor
-            self.screen.move(height - 2, len(prompt) + self.cursor_x)
-            self.screen.noutrefresh()
-            curses.doupdate()  # Update screen only once
+            self.input_win.move(1, min(len(prompt) + self.cursor_x, width - 1))
         except curses.error:
             pass
-            
+
     def refresh_screen(self, force=False):
-        """Refresh the screen with current messages and input"""
-        if not force and not self.needs_resize and not self.needs_message_refresh:
-            return
-            
-        height, width = self.screen.getmaxyx()
-        input_height = 2
-        message_area_height = height - input_height - 1
-        
+        """Draw one frame, repainting only the regions that changed.
+
+        Returns whether anything was drawn.
+        """
+        if not self.running:
+            return False
+        damage = self.damage
+        self.damage = set()
+        new_messages = self.new_messages
+        self.new_messages = 0
+        if new_messages and self.scroll_anchor is not None:
+            new_messages = 0  # Scrolled back, the viewport stays put
+        if force:
+            damage.add("all")
+
+        typing_lines = self._current_typing_lines()
+        if typing_lines != self.typing_lines:
+            if len(typing_lines) != len(self.typing_lines):
+                damage.add("layout")  # Message area grows or shrinks
+            self.typing_lines = typing_lines
+            damage.add("typing")
+
+        if self.perf_overlay and time.monotonic() >= self.perf_due:
+            self.perf_lines = self._perf_text()
+            self.perf_due = time.monotonic() + PERF_INTERVAL
+            damage.add("perf")
+
+        if not damage and not new_messages:
+            return False
+
+        started = time.perf_counter() if profiler.enabled else None
         try:
-            # Only redraw messages if needed
-            if force or self.needs_message_refresh or len(self.messages) != self.last_message_count:
-                self.messages_pad.erase()
-                current_line = 0
-                
-                # First display typing indicators
-                current_time = time.time()
-                for username, last_time in list(self.typing_users.items()):
-                    # Remove typing status if too old
-                    if current_time - last_time > self.typing_timeout:
-                        del self.typing_users[username]
-                        continue
-                        
-                    typing_lines = self._get_typing_indicator(username)
-                    lines_needed = len(typing_lines)
-                    if current_line + lines_needed <= message_area_height:
-                        for line in reversed(typing_lines):
-                            if current_line >= message_area_height:
-                                break
-                            try:
-                                self.messages_pad.addstr(
-                                    message_area_height - 1 - current_line,
-                                    0,
-                                    line[:width-1]
-                                )
-                            except curses.error:
-                                pass
-                            current_line += 1
-                            
-                # Then display messages
-                for msg in reversed(self.messages):
-                    lines_needed = len(msg["lines"])
-                    if current_line + lines_needed > message_area_height:
-                        break
-                        
-                    # Display message lines
-                    for line in reversed(msg["lines"]):
-                        if current_line >= message_area_height:
-                            break
-                        try:
-                            self.messages_pad.addstr(
-                                message_area_height - 1 - current_line,
-                                0,
-                                line[:width-1]
-                            )
-                        except curses.error:
-                            pass
-                        current_line += 1
-                        
-                self.last_message_count = len(self.messages)
-                
-            # Prepare all updates without refreshing
-            self.messages_pad.noutrefresh(0, 0, 0, 0, message_area_height - 1, width - 1)
-            
-            # Always refresh input area to keep it visible
-            self._refresh_input()
-            
+            if "all" in damage:
+                self.screen.erase()
+                self.screen.noutrefresh()
+            if "all" in damage or "layout" in damage:
+                self._init_windows()
+                damage.update(("messages", "typing", "input"))
+
+            if "messages" in damage:
+                self._draw_messages(None)
+            elif new_messages:
+                self._draw_messages(new_messages)
+            if self.perf_overlay and ("perf" in damage or "messages" in damage or new_messages):
+                self._draw_perf()
+            if "typing" in damage:
+                self._draw_typing()
+            if "input" in damage:
+                self._draw_input()
+            # Always refresh the input window last so the cursor ends up there
+            self.input_win.noutrefresh()
+            curses.doupdate()  # Update screen only once per frame
         except curses.error:
             pass
-            
-        self.needs_resize = False
-        self.needs_message_refresh = False 
\ No newline at end of file
+        if started is not None:
+            profiler.observe("repaint", time.perf_counter() - started)
+            profiler.add("frames")
+        return True
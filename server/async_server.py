@@ -0,0 +1,761 @@
+import asyncio
+import itertools
+import json
+import logging
+import signal
+import time
+import zlib
+import capture
+import cluster
+import metrics
+from outbound import OutboundQueue, SlowConsumer, set_nodelay
+from limits import ClientLimits, violations
+from rooms import DEFAULT_ROOM, valid_room
+from message_log import backlog, with_epoch
+from presence import TypingPresence, Roster, describe, TYPING_TICK, ROSTER_TICK
+from framing import (LINES, BINARY, LENGTH, KIND_MESSAGE, KIND_TYPING, encode, encode_line,
+                     encode_binary, decode_binary, decode_line, peek, valid_text, frame_with_seq,
+                     convert_frames, compressor, DEFLATE)
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+ACCEPT_BACKLOG = 1024  # Let reconnect bursts queue up in the kernel
+SHUTDOWN_TIMEOUT = 5   # Seconds to let client handlers clean up when stopping
+
+clients = {}         # Connection id -> Connection, every client receiving messages
+rooms = {}           # Room name -> {connection id: Connection}, who receives its messages
+history = None       # RoomLogs of chat messages, None when disabled
+replay_count = 0     # Messages replayed to a client when it joins
+relay_enabled = True # Forward binary chat/typing frames without decoding them
+compression_level = 6  # zlib level for clients that ask for compression; 0 refuses them
+capture_path = None  # Trace file to record inbound frames to (one per worker)
+tracer = None        # Capture writing to it, in the process that serves clients
+room_settings = None # RoomSettings with each room's salt and cipher
+bus = None           # WorkerBus when this is one of several worker processes
+pending = {}         # Connection id -> Connection waiting for its backlog from the hub
+typing = TypingPresence()  # Who is typing in each room; unused in workers (the hub has it)
+roster = Roster()    # Who is in each room, for join/leave notices; likewise
+unflushed = set()    # Connections with frames waiting for the next flush tick
+handlers = {}        # handle_client task -> its StreamWriter, to hang up on shutdown
+flush_timer = None   # Handle of the scheduled flush, while one is due
+conn_ids = itertools.count(1)
+log = logging.getLogger("cowtalk")
+
+connections_total = metrics.Counter("cowtalk_connections_total", "Clients accepted")
+frames_received = metrics.Counter("cowtalk_frames_received_total",
+                                  "Frames received from clients, by kind")
+chat_received = frames_received.labels(kind="chat")
+typing_received = frames_received.labels(kind="typing")
+other_received = frames_received.labels(kind="other")
+shed_received = frames_received.labels(kind="shed")  # Over the client's rate limit
+bytes_received = metrics.Counter("cowtalk_received_bytes_total", "Frame bytes received from clients")
+frames_sent = metrics.Counter("cowtalk_frames_sent_total", "Frames written to clients")
+bytes_sent = metrics.Counter("cowtalk_sent_bytes_total", "Bytes written to clients")
+compress_in = metrics.Counter("cowtalk_compression_input_bytes_total",
+                              "Bytes compressed for clients that asked for it")
+compress_out = metrics.Counter("cowtalk_compression_output_bytes_total",
+                               "What those bytes compressed to")
+compress_seconds = metrics.Counter("cowtalk_compression_seconds_total",
+                                   "Time spent compressing")
+slow_disconnects = metrics.Counter("cowtalk_slow_consumer_disconnects_total",
+                                   "Clients dropped for not keeping up")
+fan_out_seconds = metrics.Histogram(
+    "cowtalk_fan_out_seconds", "Time to queue one message for everyone in its room",
+    (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1))
+write_batch_frames = metrics.Histogram(
+    "cowtalk_write_batch_frames", "Frames in a client's send queue when its writer ran",
+    (1, 2, 4, 8, 16, 32, 64, 128, 256, 1024))
+metrics.Gauge("cowtalk_connections", "Connected clients",
+              read=lambda: len(clients) + len(pending))
+metrics.Gauge("cowtalk_rooms", "Rooms with members on this server", read=lambda: len(rooms))
+metrics.Gauge("cowtalk_send_queue_frames", "Frames waiting in client send queues",
+              label="stat", read=lambda: queue_depths())
+metrics.Counter("cowtalk_limit_violations_total", "Frames refused by per-client limits",
+                label="reason", read=lambda: dict(violations))
+
+def queue_depths():
+    depths = [len(conn.queue) for conn in list(clients.values())]
+    return {"total": sum(depths), "max": max(depths, default=0)}
+
+class Connection:
+    """A connected client with a bounded outbound queue and its own writer task"""
+
+    def __init__(self, writer, username, framing=LINES):
+        self.id = next(conn_ids)
+        self.writer = writer
+        self.username = username
+        self.framing = framing
+        self.negotiated = False  # Sent a framing request, so it understands welcome/room
+        self.welcomed = False
+        self.room = None
+        self.roster_seen = None  # Who its roster snapshot listed, until the room's next delta
+        self.queue = OutboundQueue()
+        self.limits = ClientLimits()
+        self.compressor = None  # Deflate context, when the client asked for compression
+        self.welcome = None  # The welcome frame, until the writer has sent it
+        self.compressing = False  # The welcome is out and the compressed stream has begun
+        self.ready = asyncio.Event()
+        self.task = asyncio.create_task(self._write_loop())
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            set_nodelay(sock)
+
+    def send(self, data):
+        """Queue an encoded frame; never blocks the caller.
+
+        Nothing queued here is droppable, so a client whose queue fills up
+        is disconnected.
+        """
+        if self.writer.is_closing():
+            return
+        try:
+            self.queue.put(data)
+        except SlowConsumer:
+            slow_disconnects.inc()
+            log.warning("[!] %s is not keeping up, disconnecting", self.username)
+            # abort() discards the transport buffer and wakes up handle_client
+            self.writer.transport.abort()
+            return
+        if OutboundQueue.flush_tick > 0:
+            schedule_flush(self)
+        else:
+            self.ready.set()
+
+    async def _write_loop(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                frames = self.queue.take_all()
+                if not frames:
+                    continue
+                write_batch_frames.observe(len(frames))
+                frames_sent.inc(len(frames))
+                if self.compressor is not None:
+                    frames = self._compress(frames)
+                bytes_sent.inc(sum(map(len, frames)))
+                self.writer.writelines(frames)
+                # While we wait for the socket, new frames pile up in our
+                # bounded queue instead of the unbounded transport buffer
+                await self.writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    def _compress(self, frames):
+        """Deflate a batch of frames into the connection's stream.
+
+        The stream is flushed after each batch, so the client can decode
+        every frame as soon as it arrives, while the dictionary carries
+        over to the next batch.
+        """
+        plain = []
+        if not self.compressing:
+            # Everything up to and including the welcome goes out as is;
+            # the client only expects deflate after it
+            for i, frame in enumerate(frames):
+                if frame is self.welcome:
+                    plain, frames = frames[:i + 1], frames[i + 1:]
+                    self.welcome = None
+                    self.compressing = True
+                    break
+            else:
+                return frames
+        if not frames:
+            return plain
+        started = time.perf_counter()
+        data = b"".join(frames)
+        compressed = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        compress_seconds.inc(time.perf_counter() - started)
+        compress_in.inc(len(data))
+        compress_out.inc(len(compressed))
+        return plain + [compressed]
+
+    def close(self):
+        self.task.cancel()
+        self.writer.close()
+
+def schedule_flush(conn):
+    """Wake a connection's writer at the next flush tick instead of now.
+
+    Everything queued for it until then goes out in one write. There is
+    one timer for all connections, not one per connection.
+    """
+    global flush_timer
+    unflushed.add(conn)
+    if flush_timer is None:
+        flush_timer = asyncio.get_running_loop().call_later(OutboundQueue.flush_tick, flush)
+
+def flush():
+    global flush_timer
+    flush_timer = None
+    for conn in unflushed:
+        conn.ready.set()
+    unflushed.clear()
+
+def fan_out(frames, to_message, room, sender=None):
+    """Queue a message for every member of a room except the sender.
+
+    frames maps a framing to its encoded bytes. Framings that aren't in it
+    yet are encoded from to_message() on first use, so each framing is
+    encoded once and all its recipients share the same bytes object.
+    Only the room's members are visited, so a quiet room costs nothing
+    when another one is busy.
+    """
+    members = rooms.get(room)
+    if not members:
+        return
+    started = time.perf_counter()
+    message = None
+    for conn in list(members.values()):
+        if conn is sender:
+            continue
+        data = frames.get(conn.framing)
+        if data is None:
+            if message is None:
+                message = to_message()
+            data = frames[conn.framing] = encode(message, conn.framing)
+        conn.send(data)
+    fan_out_seconds.observe(time.perf_counter() - started)
+
+def broadcast(message_dict, sender=None):
+    """Send a message to all clients except the sender"""
+    fan_out({}, lambda: message_dict, sender.room, sender)
+
+def publish(message_dict, sender=None):
+    """Record a chat message in the history, then broadcast it"""
+    if bus is not None:
+        # The hub logs it and sends it to every worker, this one included
+        bus.publish(sender.id, encode_binary(message_dict)[LENGTH.size:])
+        return
+    typing.remove(sender.room, sender.username)
+    announce_now(sender)
+    if history is None:
+        broadcast(message_dict, sender)
+        return
+    # The log stores binary frames, which binary clients get as-is
+    seq, frame = history.get(sender.room).append(
+        lambda seq: encode_binary(dict(message_dict, seq=seq)))
+    fan_out({BINARY: frame}, lambda: dict(message_dict, seq=seq), sender.room, sender)
+
+def relay(body, kind, sender_name, sender=None):
+    """Forward a binary chat frame without decoding its payload.
+
+    Only the routing header is read. The payload (Fernet ciphertext the
+    server can't read anyway) is copied through byte for byte; only clients
+    still on JSON lines cause it to be decoded, once per message. A text
+    payload is checked to be UTF-8 first, since those clients and the
+    backlog would fail on it later. Typing frames carry a single byte,
+    which is all we look at.
+    """
+    if kind == KIND_TYPING:
+        set_typing(sender, body[-1] == 1)
+        return
+    if not valid_text(body):
+        log.warning("Dropped a message from %s: content isn't valid UTF-8", sender.username)
+        return
+    log.debug("%s: [%d bytes]", sender_name, len(body))
+    if bus is not None:
+        bus.publish(sender.id, body)
+        return
+    typing.remove(sender.room, sender.username)
+    announce_now(sender)
+    if history is not None:
+        _, frame = history.get(sender.room).append(lambda seq: frame_with_seq(body, seq))
+    else:
+        frame = LENGTH.pack(len(body)) + body
+    fan_out({BINARY: frame}, lambda: decode_binary(memoryview(frame)[LENGTH.size:]),
+            sender.room, sender)
+
+def set_typing(sender, is_typing):
+    """Record a typing update. Nothing is sent now: the typing tick tells
+    the room once its set of typists has changed.
+    """
+    if bus is not None:
+        bus.typing(sender.id, is_typing)
+        return
+    typing.update(sender.room, sender.username, is_typing)
+
+def send_typing(room, users, previous, members=None):
+    """Tell a room's members who is typing now.
+
+    Clients that negotiated get one "typing" snapshot; older ones only
+    understand per-user typing_status, so they get one for each user that
+    started or stopped. Every framing is encoded once. These are never
+    shed: a lost snapshot would leave a stale indicator up, and there are
+    at most a few per second.
+    """
+    if members is None:
+        members = rooms.get(room)
+    if not members:
+        return
+    snapshot = {"type": "typing", "room": room, "users": list(users)}
+    frames = {}
+    deltas = None
+    for conn in list(members.values()):
+        if not conn.negotiated:
+            if deltas is None:
+                deltas = b"".join(
+                    [encode_line({"type": "typing_status", "username": u, "is_typing": True})
+                     for u in users if u not in previous] +
+                    [encode_line({"type": "typing_status", "username": u, "is_typing": False})
+                     for u in previous if u not in users])
+            data = deltas
+        else:
+            data = frames.get(conn.framing)
+            if data is None:
+                data = frames[conn.framing] = encode(snapshot, conn.framing)
+        if data:
+            conn.send(data)
+
+async def typing_loop():
+    """Send each room's typists when they change, at most once per tick"""
+    while True:
+        await asyncio.sleep(TYPING_TICK)
+        for room, users, previous in typing.tick():
+            send_typing(room, users, previous)
+
+def send_roster(room, joined, left):
+    """Tell a room's members who joined and left it since the last tick.
+
+    Clients that negotiated get one "roster" delta to render as they
+    like; older ones get a System line for each direction. Each version
+    is encoded once, except for clients that joined since the last
+    delta: their snapshot already covers part of it, so they only hear
+    about joins it didn't list and leaves of users it did.
+    """
+    members = rooms.get(room)
+    if not members:
+        return
+    frames = {}  # (framing, negotiated) -> the delta for members with no snapshot pending
+    for conn in list(members.values()):
+        seen, conn.roster_seen = conn.roster_seen, None
+        if seen is None:
+            data = frames.get((conn.framing, conn.negotiated))
+            if data is None:
+                data = frames[(conn.framing, conn.negotiated)] = encode_roster(
+                    conn, room, joined, left)
+        else:
+            data = encode_roster(conn, room, [u for u in joined if u not in seen],
+                                 [u for u in left if u in seen])
+        if data:
+            conn.send(data)
+
+def encode_roster(conn, room, joined, left):
+    """A roster delta as conn understands it; empty if there's nothing in it"""
+    if not conn.negotiated:
+        notices = b""
+        if joined:
+            notices += encode_line(system_message(describe(joined, "joined the chat")))
+        if left:
+            notices += encode_line(system_message(describe(left, "left the chat")))
+        return notices
+    if not joined and not left:
+        return b""
+    return encode({"type": "roster", "room": room, "joined": joined, "left": left}, conn.framing)
+
+def send_roster_snapshot(conn, users):
+    """Tell a client who is in the room it just joined"""
+    conn.roster_seen = set(users)  # Older clients get no snapshot but know they're in
+    if conn.negotiated:
+        conn.send(encode({"type": "roster", "room": conn.room, "users": users}, conn.framing))
+
+def announce_now(sender):
+    """Send the sender's room its pending roster delta ahead of the tick if
+    the sender's arrival is in it, so their first message never comes
+    before the notice that they joined
+    """
+    change = roster.flush(sender.room, sender.username)
+    if change is not None:
+        send_roster(sender.room, *change)
+
+async def roster_loop():
+    """Announce joins and leaves, batched per room, at most once per tick"""
+    while True:
+        await asyncio.sleep(ROSTER_TICK)
+        for room, joined, left in roster.tick():
+            send_roster(room, joined, left)
+
+def handle_message(message, sender):
+    """Act on a decoded message from a client"""
+    if message.get("type") == "message":
+        sender_name = message.get("username", "Anonymous")
+        content = message.get("content", "")
+        if not isinstance(content, (str, bytes)):
+            log.warning("Dropped a message from %s: content of type %s",
+                        sender.username, type(content).__name__)
+            return
+        log.debug("%s: %s", sender_name, content)
+        # Forward to other clients
+        publish(message, sender=sender)
+    elif message.get("type") == "typing_status":
+        set_typing(sender, bool(message.get("is_typing")))
+    elif message.get("type") == "join":
+        room = message.get("room")
+        if not valid_room(room):
+            sender.send(encode(system_message(f"Can't join {room!r}: room names are "
+                                              "1-32 letters, digits, _ or -"), sender.framing))
+        elif room != sender.room:
+            enter_room(sender, room)
+
+def system_message(content):
+    return {"type": "message", "username": "System", "content": content}
+
+def send_room_info(conn, settings):
+    """Tell a client which room it's in and how to derive that room's key.
+
+    The first one is the welcome, which also settles the framing and
+    compression; later ones are "room" messages after a /join. Clients
+    that never negotiated predate rooms and get neither.
+    """
+    if not conn.negotiated:
+        return
+    if not conn.welcomed:
+        conn.welcomed = True
+        welcome = dict(settings, type="welcome", framing=conn.framing, room=conn.room)
+        if conn.compressor is not None:
+            welcome["compression"] = DEFLATE
+        conn.welcome = encode_line(welcome)
+        conn.send(conn.welcome)
+    else:
+        conn.send(encode(dict(settings, type="room", room=conn.room), conn.framing))
+
+def deliver_typing(room, users, previous):
+    """The hub's typing tick changed a room's typists"""
+    send_typing(room, users, previous)
+
+def deliver_roster(room, joined, left):
+    """The hub's roster tick changed a room's members"""
+    send_roster(room, joined, left)
+
+def deliver_bus_frame(frame, room, worker, conn_id):
+    """Fan out a frame the hub sent to every worker"""
+    sender = clients.get(conn_id) if worker == bus.index else None
+    fan_out({BINARY: frame}, lambda: decode_binary(memoryview(frame)[LENGTH.size:]),
+            room, sender)
+
+def go_live(conn_id, settings, typists, users, missed):
+    """The hub has added a client to its room; send the backlog and start delivering"""
+    conn = pending.pop(conn_id, None)
+    if conn is None or conn.writer.is_closing():
+        return
+    send_room_info(conn, settings)
+    if missed:
+        conn.send(convert_frames(missed, conn.framing))
+    send_roster_snapshot(conn, users)
+    if typists:
+        send_typing(conn.room, typists, (), {conn.id: conn})
+    rooms.setdefault(conn.room, {})[conn.id] = conn
+    clients[conn.id] = conn
+
+def enter_room(conn, room, last_seq=None, epoch=None):
+    """Move a client into a room, announce it and send it the room's backlog.
+
+    A reconnecting client passes the last seq it saw, and the epoch it saw
+    it in, and gets everything after it instead of the usual backlog.
+    """
+    if conn.room is not None:
+        leave_room(conn)
+    conn.room = room
+    if bus is not None:
+        # The hub announces it cluster-wide (and the departure from the old
+        # room) and replies with the room's settings and backlog
+        clients.pop(conn.id, None)
+        pending[conn.id] = conn
+        bus.join(conn.id, room, conn.username, last_seq, epoch)
+        return
+
+    settings = room_settings.get(room) if room_settings is not None else {}
+    send_room_info(conn, with_epoch(settings, history.get(room) if history is not None else None))
+    rooms.setdefault(room, {})[conn.id] = conn
+    clients[conn.id] = conn
+
+    # Everyone else hears about it with the next roster tick
+    roster.join(room, conn.username)
+
+    # Stream the backlog right away. It's one small positioned read, done
+    # inline so no live message can overtake it
+    if history is not None:
+        missed = backlog(history.get(room), replay_count, last_seq, epoch)
+        if missed:
+            conn.send(convert_frames(missed, conn.framing))
+    send_roster_snapshot(conn, roster.users(room))
+
+    # Snapshots only go out on changes, so show who is already typing
+    typists = typing.typists(room)
+    if typists:
+        send_typing(room, typists, (), {conn.id: conn})
+
+def leave_room(conn):
+    """Take a client out of its room's member index"""
+    members = rooms.get(conn.room)
+    if members is not None and members.pop(conn.id, None) is not None:
+        if not members:
+            del rooms[conn.room]
+        if bus is None:
+            typing.remove(conn.room, conn.username)
+            roster.leave(conn.room, conn.username)
+
+def leave(conn):
+    """Forget a disconnected client and tell its room"""
+    clients.pop(conn.id, None)
+    pending.pop(conn.id, None)
+    leave_room(conn)
+    if bus is not None:
+        bus.leave(conn.id)
+
+async def read_frame(reader, framing, limits):
+    """Read the next raw frame from a client, or None once it has gone.
+
+    Returns the body of a binary frame, or one JSON line. Oversized frames
+    end the connection.
+    """
+    if framing == BINARY:
+        try:
+            length = LENGTH.unpack(await reader.readexactly(LENGTH.size))[0]
+            if limits.frame_too_large(length):
+                log.warning("Error: frame of %d bytes is too large", length)
+                return None
+            return await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            return None  # Connection closed mid-frame
+
+    try:
+        line = await reader.readline()
+    except ValueError:
+        # No newline within the reader's buffer limit
+        violations["frame_size"] += 1
+        log.warning("Error: line is too long")
+        return None
+    if not line.endswith(b'\n'):
+        return None  # Closed, possibly mid-frame
+    if limits.frame_too_large(len(line)):
+        log.warning("Error: line of %d bytes is too long", len(line))
+        return None
+    return line
+
+def shed(conn, violation):
+    """Drop a frame that went over budget, warning the client if it's the
+    first in a while; False if there was no violation
+    """
+    if not violation:
+        return False
+    shed_received.inc()
+    if conn.limits.should_warn(violation):
+        conn.send(encode(system_message(
+            "You're sending too fast, messages are being dropped"), conn.framing))
+    return True
+
+async def handle_client(reader, writer):
+    addr = writer.get_extra_info('peername')
+    conn = None
+    handlers[asyncio.current_task()] = writer
+    try:
+        # The first line is the connect message containing the username
+        line = await reader.readline()
+        if not line:
+            return
+
+        message = json.loads(line)
+        username = message.get("username", "Anonymous")
+        room = message.get("room", DEFAULT_ROOM)
+        if not valid_room(room):
+            room = DEFAULT_ROOM
+        last_seq = message.get("last_seq")  # Set when reconnecting
+        if not isinstance(last_seq, int) or isinstance(last_seq, bool) or last_seq < -1:
+            last_seq = None
+        epoch = message.get("epoch")  # The history epoch last_seq is from
+        if not isinstance(epoch, str) or not epoch.isalnum():
+            epoch = None
+
+        conn = Connection(writer, username)
+        connections_total.inc()
+        if tracer is not None:
+            tracer.record(conn.id, capture.CONNECT, line)
+        requested = message.get("framing")
+        if requested is not None:
+            # Clients that negotiate get a welcome, as a JSON line, before
+            # anything else; everything after it uses the agreed framing
+            conn.negotiated = True
+            if requested == BINARY:
+                conn.framing = BINARY
+            if message.get("compression") == DEFLATE and compression_level > 0:
+                conn.compressor = compressor(compression_level)
+        log.info("[+] %s connected from %s", username, addr)
+        enter_room(conn, room, last_seq, epoch)
+
+        while True:
+            frame = await read_frame(reader, conn.framing, conn.limits)
+            if frame is None:
+                break
+            bytes_received.inc(len(frame))
+            if tracer is not None:
+                tracer.record(conn.id, capture.BINARY if conn.framing == BINARY else capture.LINE,
+                              frame)
+
+            # Shed floods before spending anything on decoding them
+            if shed(conn, conn.limits.check_frame()):
+                continue
+            try:
+                if conn.framing == BINARY:
+                    if shed(conn, conn.limits.check_binary(frame)):
+                        continue
+                    kind, sender_name = peek(frame)
+                    if kind == KIND_MESSAGE:
+                        chat_received.inc()
+                    elif kind == KIND_TYPING:
+                        typing_received.inc()
+                    else:
+                        other_received.inc()
+                    if relay_enabled and kind in (KIND_MESSAGE, KIND_TYPING):
+                        relay(frame, kind, sender_name, sender=conn)
+                        continue
+                    message = decode_binary(frame)
+                else:
+                    # A line's type decides its budget, so it's parsed first
+                    message = decode_line(frame)
+                    if shed(conn, conn.limits.check_message(message)):
+                        continue
+                    msg_type = message.get("type")
+                    if msg_type == "message":
+                        chat_received.inc()
+                    elif msg_type == "typing_status":
+                        typing_received.inc()
+                    else:
+                        other_received.inc()
+            except ValueError as e:
+                # Bad JSON, bad UTF-8 or a malformed frame (FrameError); the
+                # stream is still in sync so just skip it. A bad line never
+                # reached its budget, so it's charged as chat
+                if conn.framing != BINARY and shed(conn, conn.limits.check(False)):
+                    continue
+                log.warning("Error decoding message: %s", e)
+                continue
+
+            try:
+                handle_message(message, conn)
+            except Exception as e:
+                log.error("Error processing message: %s", e)
+
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    except ValueError as e:
+        # Oversized connect line or a malformed connect message
+        log.warning("Error: %s", e)
+    except Exception as e:
+        log.error("Error: %s", e)
+    finally:
+        if conn is not None:
+            if tracer is not None:
+                tracer.record(conn.id, capture.CLOSE)
+            conn.close()
+            if conn.room is not None:
+                log.info("[-] %s disconnected.", conn.username)
+                leave(conn)
+        else:
+            writer.close()
+        handlers.pop(asyncio.current_task(), None)
+
+def raise_fd_limit():
+    """Raise the open file soft limit so we can hold many idle connections"""
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > soft:
+            target = hard if hard != resource.RLIM_INFINITY else max(soft, 65536)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    except (ValueError, OSError):
+        pass
+
+async def serve(host, port, bus_sock=None, worker=0, admin=None):
+    global tracer
+    # SIGTERM (from a service manager, or the hub stopping its workers)
+    # cancels this task, so we stop between callbacks and the finally
+    # blocks here and in main() flush the trace and the message log
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    if capture_path is not None:
+        # Connection ids are per process, so each worker keeps its own trace
+        tracer = capture.Capture(capture_path if bus_sock is None else f"{capture_path}.{worker}")
+    try:
+        await listen(host, port, bus_sock, worker, admin)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        loop.add_signal_handler(signal.SIGTERM, lambda: None)  # Already stopping
+        try:
+            await hang_up()
+        finally:
+            if tracer is not None:
+                tracer.close()
+
+async def hang_up():
+    """Disconnect every client and wait for its handler to clean up.
+
+    Handlers left running would be cancelled by asyncio.run() instead,
+    which skips their bookkeeping and logs a traceback for each.
+    """
+    tasks = list(handlers)
+    for writer in handlers.values():
+        writer.transport.abort()
+    if tasks:
+        await asyncio.wait(tasks, timeout=SHUTDOWN_TIMEOUT)
+
+async def listen(host, port, bus_sock, worker, admin):
+    global bus
+    if admin is not None:
+        # One endpoint per process; workers take consecutive ports
+        admin_host, admin_port = admin
+        metrics.serve(admin_host, admin_port + worker)
+    server = await asyncio.start_server(
+        handle_client, host, port,
+        # A StreamReader stops reading from the socket once it holds twice
+        # its limit, which caps what a client can make us buffer unparsed
+        limit=max(ClientLimits.max_frame, ClientLimits.max_buffer // 2),
+        backlog=ACCEPT_BACKLOG,
+        reuse_address=True,
+        reuse_port=bus_sock is not None
+    )
+
+    if bus_sock is None:
+        log.info("[💬 Server started] Listening on port %d (asyncio)...", port)
+        asyncio.create_task(typing_loop())
+        asyncio.create_task(roster_loop())
+        async with server:
+            await server.serve_forever()
+        return
+
+    reader, writer = await asyncio.open_unix_connection(sock=bus_sock)
+    bus = cluster.WorkerBus(worker, reader, writer, deliver_bus_frame, go_live,
+                            deliver_typing, deliver_roster)
+    log.info("[💬 Worker %d] Listening on port %d (asyncio)...", worker, port)
+    async with server:
+        # Without the hub we can't reach anyone, so stop with it
+        await bus.run()
+        writer.close()  # Leaving clients have no one to tell
+
+def run(host, port, message_logs=None, replay=0, relay=True, rooms=None, workers=1, admin=None,
+        compression=6, capture_file=None):
+    global history, replay_count, relay_enabled, room_settings, compression_level, capture_path
+    compression_level = compression
+    capture_path = capture_file
+    room_settings = rooms
+    history = message_logs
+    replay_count = replay
+    relay_enabled = relay
+    raise_fd_limit()
+    if workers > 1:
+        # The hub in this process owns the logs and room settings; workers
+        # go through it
+        history = None
+        room_settings = None
+        cluster.run(workers, lambda index, sock: asyncio.run(serve(host, port, sock, index, admin)),
+                    message_logs, replay, rooms)
+        return
+    try:
+        asyncio.run(serve(host, port, admin=admin))
+    except KeyboardInterrupt:
+        pass
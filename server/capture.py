@@ -0,0 +1,75 @@
+import struct
+import threading
+import time
+
+# A trace of everything clients sent one server process, for replaying
+# production traffic against another build (bench/replay.py). The file is
+# MAGIC followed by records of RECORD and then the record's data:
+#   f64 wall-clock time, u32 connection id, u8 event, u32 data length
+MAGIC = b"CWTRACE\x01"
+RECORD = struct.Struct('!dIBI')
+FLUSH_INTERVAL = 1.0  # Seconds between batched writes
+
+CONNECT = 0  # Data is the connect line, newline included
+LINE = 1     # Data is a JSON line, newline included
+BINARY = 2   # Data is a binary frame body, without its length
+CLOSE = 3    # The client disconnected; no data
+
+class Capture:
+    """Records inbound frames to a trace file.
+
+    record() only queues the record in memory; a background thread
+    writes pending records every FLUSH_INTERVAL, so capturing costs the
+    event loop a struct.pack and a list append per frame.
+    """
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.lock = threading.Lock()
+        self.closed = False
+        self.wakeup = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def record(self, conn, event, data=b""):
+        header = RECORD.pack(time.time(), conn, event, len(data))
+        with self.lock:
+            self.pending.append(header)
+            self.pending.append(bytes(data))
+
+    def _flush_loop(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if batch:
+            self.file.write(b"".join(batch))
+            self.file.flush()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.flusher.join()
+        self.flush()
+        self.file.close()
+
+def read_trace(path):
+    """Yield (time, conn, event, data) for every record in a trace file"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a cowtalk trace")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return  # A capture cut off mid-record ends here
+            timestamp, conn, event, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield timestamp, conn, event, data
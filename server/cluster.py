@@ -0,0 +1,278 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+from framing import LENGTH, frame_with_seq
+from message_log import backlog, with_epoch
+from presence import TypingPresence, Roster, TYPING_TICK, ROSTER_TICK
+
+log = logging.getLogger("cowtalk")
+
+# Worker processes share the listening port through SO_REUSEPORT, so the
+# kernel spreads connections across them. Each worker is linked to the hub
+# (the parent process) by a Unix socket pair; everything that has to reach
+# clients on other workers goes through the hub, which owns the message
+# logs, the room settings, the cluster-wide member registry and who is
+# typing, and puts all traffic in one order.
+#
+# A bus frame is a u32 length followed by:
+#   u8 op, u8 worker, u8 flags (none defined yet, always 0), u32 connection id, payload
+ENVELOPE = struct.Struct('!BBBI')
+
+# Worker -> hub
+OP_PUBLISH = 1  # Payload is a chat frame body; logged, then sent to every worker
+OP_TYPING = 2   # Payload is one byte, 1 while the client is typing
+OP_JOIN = 3     # Payload is JSON: room, username, last seq seen and its history epoch
+                # (null if not resuming); for a new client or a room change
+OP_LEAVE = 4    # The client has disconnected
+# Hub -> worker
+OP_FRAME = 5    # Payload is u8 room length, room, then a complete binary frame for its members
+OP_BACKLOG = 6  # Payload is u32 length, JSON with the room settings, who is typing and
+                # who is there, then the room's history for a joining client, which goes
+                # live after this
+OP_PRESENCE = 7 # Payload is JSON: a room's typists now and in its previous snapshot
+OP_ROSTER = 8   # Payload is JSON: who joined and left a room since the last roster tick
+
+def pack(op, worker, conn, payload=b""):
+    return b"".join((LENGTH.pack(ENVELOPE.size + len(payload)),
+                     ENVELOPE.pack(op, worker, 0, conn), payload))
+
+async def read_bus_frame(reader):
+    """(op, worker, flags, conn, payload), or None once the other side is gone"""
+    try:
+        length = LENGTH.unpack(await reader.readexactly(LENGTH.size))[0]
+        body = await reader.readexactly(length)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    op, worker, flags, conn = ENVELOPE.unpack_from(body)
+    return op, worker, flags, conn, memoryview(body)[ENVELOPE.size:]
+
+class WorkerBus:
+    """A worker's end of the link to the hub"""
+
+    def __init__(self, index, reader, writer, on_frame, on_backlog, on_typing, on_roster):
+        self.index = index
+        self.reader = reader
+        self.writer = writer
+        self.on_frame = on_frame      # on_frame(frame, room, origin_worker, origin_conn)
+        self.on_backlog = on_backlog  # on_backlog(conn, settings, typists, users, backlog)
+        self.on_typing = on_typing    # on_typing(room, users, previous)
+        self.on_roster = on_roster    # on_roster(room, joined, left)
+
+    def _send(self, op, conn, payload=b""):
+        # The hub is a local process that only routes, so it keeps up;
+        # the transport buffer absorbs short bursts
+        if not self.writer.is_closing():
+            self.writer.write(pack(op, self.index, conn, payload))
+
+    def publish(self, conn, body):
+        self._send(OP_PUBLISH, conn, body)
+
+    def typing(self, conn, is_typing):
+        self._send(OP_TYPING, conn, b'\x01' if is_typing else b'\x00')
+
+    def join(self, conn, room, username, last_seq=None, epoch=None):
+        self._send(OP_JOIN, conn, json.dumps({"room": room, "username": username,
+                                              "last_seq": last_seq, "epoch": epoch}).encode('utf-8'))
+
+    def leave(self, conn):
+        self._send(OP_LEAVE, conn)
+
+    async def run(self):
+        """Dispatch frames from the hub until it goes away"""
+        while True:
+            frame = await read_bus_frame(self.reader)
+            if frame is None:
+                return
+            op, worker, flags, conn, payload = frame
+            if op == OP_FRAME:
+                room_end = 1 + payload[0]
+                room = str(payload[1:room_end], 'utf-8')
+                self.on_frame(bytes(payload[room_end:]), room, worker, conn)
+            elif op == OP_BACKLOG:
+                header_end = LENGTH.size + LENGTH.unpack_from(payload)[0]
+                header = json.loads(bytes(payload[LENGTH.size:header_end]))
+                self.on_backlog(conn, header["settings"], header["typing"], header["users"],
+                                bytes(payload[header_end:]))
+            elif op == OP_PRESENCE:
+                change = json.loads(bytes(payload))
+                self.on_typing(change["room"], change["users"], change["previous"])
+            elif op == OP_ROSTER:
+                change = json.loads(bytes(payload))
+                self.on_roster(change["room"], change["joined"], change["left"])
+
+class Hub:
+    """Routes traffic between workers and keeps the member registry"""
+
+    def __init__(self, message_logs=None, replay=0, rooms=None):
+        self.history = message_logs  # RoomLogs
+        self.replay_count = replay
+        self.room_settings = rooms
+        self.links = {}    # Worker index -> StreamWriter
+        self.members = {}  # (worker, conn) -> (username, room), every client in the cluster
+        self.typing = TypingPresence()
+        self.roster = Roster()
+
+    def broadcast(self, room, frame, worker=0, conn=0):
+        """Send a complete binary frame for a room's members to every worker.
+
+        (worker, conn) is the client it came from, which doesn't get it back.
+        """
+        room = room.encode('utf-8')
+        data = pack(OP_FRAME, worker, conn, bytes((len(room),)) + room + frame)
+        for link in self.links.values():
+            link.write(data)
+
+    def handle(self, op, worker, conn, payload):
+        if op == OP_JOIN:
+            join = json.loads(bytes(payload))
+            self.join(worker, conn, join["room"], join["username"], join["last_seq"], join["epoch"])
+            return
+        member = self.members.get((worker, conn))
+        if member is None:
+            return
+        room = member[1]
+        if op == OP_PUBLISH:
+            self.typing.remove(room, member[0])
+            change = self.roster.flush(room, member[0])
+            if change is not None:
+                self.send_roster(room, *change)  # So the join goes out before the message
+            if self.history is not None:
+                _, frame = self.history.get(room).append(lambda seq: frame_with_seq(payload, seq))
+            else:
+                frame = LENGTH.pack(len(payload)) + payload
+            self.broadcast(room, frame, worker, conn)
+        elif op == OP_TYPING:
+            self.typing.update(room, member[0], payload[0] == 1)
+        elif op == OP_LEAVE:
+            self.leave(worker, conn)
+
+    def join(self, worker, conn, room, username, last_seq=None, epoch=None):
+        if (worker, conn) in self.members:
+            self.leave(worker, conn)  # Changing rooms
+        self.members[(worker, conn)] = (username, room)
+        self.roster.join(room, username)
+        # The backlog follows every frame broadcast before it on this
+        # link, and the client only goes live once it arrives, so nothing
+        # is missed or delivered twice
+        missed = b""
+        if self.history is not None:
+            missed = backlog(self.history.get(room), self.replay_count, last_seq, epoch)
+        settings = {}
+        if self.room_settings is not None:
+            settings = self.room_settings.get(room)
+        settings = with_epoch(settings, self.history.get(room) if self.history is not None else None)
+        header = json.dumps({"settings": settings,
+                             "typing": list(self.typing.typists(room)),
+                             "users": self.roster.users(room)}).encode('utf-8')
+        self.links[worker].write(pack(OP_BACKLOG, worker, conn, b"".join(
+            (LENGTH.pack(len(header)), header, missed))))
+
+    def leave(self, worker, conn):
+        member = self.members.pop((worker, conn), None)
+        if member is not None:
+            username, room = member
+            self.typing.remove(room, username)
+            self.roster.leave(room, username)
+
+    async def typing_loop(self):
+        """Send typing changes to every worker, at most once per room per tick"""
+        while True:
+            await asyncio.sleep(TYPING_TICK)
+            for room, users, previous in self.typing.tick():
+                data = pack(OP_PRESENCE, 0, 0, json.dumps(
+                    {"room": room, "users": users, "previous": previous}).encode('utf-8'))
+                for link in self.links.values():
+                    link.write(data)
+
+    def send_roster(self, room, joined, left):
+        data = pack(OP_ROSTER, 0, 0, json.dumps(
+            {"room": room, "joined": joined, "left": left}).encode('utf-8'))
+        for link in self.links.values():
+            link.write(data)
+
+    async def roster_loop(self):
+        """Send joins and leaves to every worker, batched per room per tick"""
+        while True:
+            await asyncio.sleep(ROSTER_TICK)
+            for room, joined, left in self.roster.tick():
+                self.send_roster(room, joined, left)
+
+    async def serve_worker(self, index, sock):
+        reader, writer = await asyncio.open_unix_connection(sock=sock)
+        self.links[index] = writer
+        while True:
+            frame = await read_bus_frame(reader)
+            if frame is None:
+                break
+            op, _, _, conn, payload = frame
+            try:
+                self.handle(op, index, conn, payload)
+            except Exception as e:
+                log.error("Error routing bus frame: %s", e)
+        # The worker died; its clients are gone with it
+        log.warning("[!] Worker %d exited", index)
+        del self.links[index]
+        for worker, conn in [key for key in self.members if key[0] == index]:
+            self.leave(worker, conn)
+
+    async def serve(self, socks):
+        # Like a worker, stop on SIGTERM so run() can stop the workers and
+        # the message logs get closed
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        asyncio.create_task(self.typing_loop())
+        asyncio.create_task(self.roster_loop())
+        try:
+            await asyncio.gather(*(self.serve_worker(i, sock) for i, sock in socks.items()))
+        except asyncio.CancelledError:
+            pass
+
+def run(workers, run_worker, message_logs=None, replay=0, rooms=None):
+    """Fork workers and route between them until interrupted.
+
+    run_worker(index, sock) runs in each child with its end of the bus and
+    must serve clients until the socket closes.
+    """
+    if not hasattr(socket, "SO_REUSEPORT") or not hasattr(os, "fork"):
+        raise SystemExit("--workers needs SO_REUSEPORT and fork() (Linux or BSD)")
+
+    socks = {}
+    pids = []
+    for index in range(workers):
+        hub_sock, worker_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        pid = os.fork()
+        if pid == 0:
+            # Child: keep only our own end of our own link
+            hub_sock.close()
+            for sock in socks.values():
+                sock.close()
+            status = 0
+            try:
+                run_worker(index, worker_sock)
+            except KeyboardInterrupt:
+                pass
+            except Exception as e:
+                log.error("Worker %d failed: %s", index, e)
+                status = 1
+            finally:
+                os._exit(status)
+        worker_sock.close()
+        socks[index] = hub_sock
+        pids.append(pid)
+
+    log.info("[💬 Cluster started] %d worker processes", workers)
+    try:
+        asyncio.run(Hub(message_logs, replay, rooms).serve(socks))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            os.waitpid(pid, 0)
@@ -0,0 +1,266 @@
+import base64
+import json
+import struct
+import zlib
+
+# The client and server are deployed separately, so each ships a copy of this
+# module (client/framing.py and server/framing.py). Keep the two identical.
+
+LINES = "json"      # Newline-delimited JSON, the original protocol
+BINARY = "binary"   # Length-prefixed, struct-packed frames
+
+DEFLATE = "deflate" # Compression: everything the server sends after the welcome is
+                    # one raw deflate stream, sync-flushed after every write
+DEFLATE_WBITS = -12 # 4 KB window, enough to span the last few frames; with memLevel 5
+                    # a connection's compressor takes about 32 KB instead of 256 KB
+
+# A binary frame is a u32 body length followed by the body:
+#   u8 kind, u8 flags, u64 seq, u8 sender length, sender, payload
+HEADER = struct.Struct('!IBBQB')
+LENGTH = struct.Struct('!I')
+BODY_HEADER = struct.Struct('!BBQB')
+SEQ_FIELD = struct.Struct('!BQ')  # flags and seq, right after the kind
+
+KIND_JSON = 0      # Payload is a JSON object; used for everything else
+KIND_MESSAGE = 1   # Payload is the message content, UTF-8 unless FLAG_RAW
+KIND_TYPING = 2    # Payload is one byte, 1 while typing
+
+FLAG_SEQ = 0x01    # The seq field is set
+FLAG_RAW = 0x02    # Message content is raw bytes (AEAD ciphertext), not text
+
+MAX_FRAME = 1024 * 1024
+
+MESSAGE_KEYS = {"type", "username", "content", "seq"}
+TYPING_KEYS = {"type", "username", "is_typing"}
+
+class FrameError(ValueError):
+    """Raised for frames that are malformed or too large"""
+
+def encode_line(message_dict):
+    """Encode a message as one newline-delimited JSON frame.
+
+    JSON can't carry raw bytes, so bytes content goes out as base64 with
+    "encoding": "base64" and comes back as bytes from decode_line().
+    """
+    content = message_dict.get("content")
+    if isinstance(content, (bytes, bytearray, memoryview)):
+        message_dict = dict(message_dict, content=base64.b64encode(content).decode('ascii'),
+                            encoding="base64")
+    return (json.dumps(message_dict) + "\n").encode('utf-8')
+
+def decode_line(line):
+    """Decode one JSON line (without the newline) to a dict"""
+    message = json.loads(bytes(line))
+    if message.get("encoding") == "base64" and isinstance(message.get("content"), str):
+        del message["encoding"]
+        message["content"] = base64.b64decode(message["content"])
+    return message
+
+def _pack(kind, sender, payload, seq=None, flags=0):
+    sender = sender.encode('utf-8')
+    if len(sender) > 255:
+        sender = sender[:255].decode('utf-8', 'ignore').encode('utf-8')
+    if seq is not None:
+        flags |= FLAG_SEQ
+    body_length = BODY_HEADER.size + len(sender) + len(payload)
+    return HEADER.pack(body_length, kind, flags, seq or 0, len(sender)) + sender + payload
+
+def encode_binary(message_dict):
+    """Encode a message as one length-prefixed binary frame"""
+    msg_type = message_dict.get("type")
+    keys = message_dict.keys()
+    if msg_type == "message" and keys <= MESSAGE_KEYS:
+        content = message_dict.get("content", "")
+        if isinstance(content, str):
+            return _pack(KIND_MESSAGE, message_dict.get("username", ""),
+                         content.encode('utf-8'), message_dict.get("seq"))
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            return _pack(KIND_MESSAGE, message_dict.get("username", ""),
+                         bytes(content), message_dict.get("seq"), FLAG_RAW)
+        # Anything else (a number, say) is left to JSON; bytes(n) would be n zeros
+    if msg_type == "typing_status" and keys <= TYPING_KEYS:
+        return _pack(KIND_TYPING, message_dict.get("username", ""),
+                     b'\x01' if message_dict.get("is_typing") else b'\x00')
+    return _pack(KIND_JSON, "", json.dumps(message_dict).encode('utf-8'))
+
+def encode(message_dict, framing=LINES):
+    """Encode a message for a connection using the given framing"""
+    if framing == BINARY:
+        return encode_binary(message_dict)
+    return encode_line(message_dict)
+
+def compressor(level=6):
+    """Deflate context for one connection's outgoing stream"""
+    return zlib.compressobj(level, zlib.DEFLATED, DEFLATE_WBITS, 5)
+
+def peek(body):
+    """Routing header (kind, sender) of a binary frame body.
+
+    Only the fixed header and the sender are read; the payload is left alone.
+    """
+    if len(body) < BODY_HEADER.size:
+        raise FrameError("Truncated frame header")
+    kind, _, _, sender_length = BODY_HEADER.unpack_from(body)
+    sender = body[BODY_HEADER.size:BODY_HEADER.size + sender_length]
+    return kind, str(sender, 'utf-8')
+
+def valid_text(body):
+    """Whether a binary frame body's payload decodes. Only text message
+    payloads are checked: FLAG_RAW content is bytes by definition and the
+    other kinds are decoded anyway when they're handled
+    """
+    kind, flags, _, sender_length = BODY_HEADER.unpack_from(body)
+    if kind != KIND_MESSAGE or flags & FLAG_RAW:
+        return True
+    try:
+        str(memoryview(body)[BODY_HEADER.size + sender_length:], 'utf-8')
+    except UnicodeDecodeError:
+        return False
+    return True
+
+def frame_with_seq(body, seq):
+    """Complete frame for a binary body with its seq set.
+
+    The sender and payload bytes are copied through untouched.
+    """
+    view = memoryview(body)
+    return b"".join((
+        LENGTH.pack(len(body)),
+        view[:1],
+        SEQ_FIELD.pack(view[1] | FLAG_SEQ, seq),
+        view[1 + SEQ_FIELD.size:]
+    ))
+
+def decode_binary(body):
+    """Decode a binary frame body (everything after the length) to a dict"""
+    body = memoryview(body)
+    if len(body) < BODY_HEADER.size:
+        raise FrameError("Truncated frame header")
+    kind, flags, seq, sender_length = BODY_HEADER.unpack_from(body)
+    start = BODY_HEADER.size + sender_length
+    if len(body) < start:
+        raise FrameError("Truncated sender")
+    sender = str(body[BODY_HEADER.size:start], 'utf-8')
+    payload = body[start:]
+
+    if kind == KIND_MESSAGE:
+        content = bytes(payload) if flags & FLAG_RAW else str(payload, 'utf-8')
+        message = {"type": "message", "username": sender, "content": content}
+        if flags & FLAG_SEQ:
+            message["seq"] = seq
+        return message
+    if kind == KIND_TYPING:
+        return {"type": "typing_status", "username": sender, "is_typing": payload[:1] == b'\x01'}
+    if kind == KIND_JSON:
+        return json.loads(bytes(payload))
+    raise FrameError(f"Unknown frame kind {kind}")
+
+def convert_frames(data, framing):
+    """Convert a run of complete binary frames to the given framing.
+
+    Records that don't decode (logged before the server checked them) are
+    left out, so one bad record can't cost a client the whole backlog.
+    """
+    if framing == BINARY:
+        return data
+    reader = FrameReader(BINARY, max_frame=len(data))
+    reader.feed(data)
+    converted = []
+    while True:
+        try:
+            message = reader.next_message()
+        except ValueError:
+            continue  # The reader has already moved past it
+        if message is None:
+            return b"".join(converted)
+        converted.append(encode(message, framing))
+
+class FrameReader:
+    """Incremental frame parser for either framing.
+
+    Received data is appended to a bytearray and complete frames are parsed
+    in place through a memoryview, so bursts cost linear time and UTF-8 is
+    only decoded once per complete frame. The framing can be switched
+    between two next_message() calls, which is how the handshake upgrades
+    a connection from JSON lines to binary frames.
+    """
+
+    def __init__(self, framing=LINES, max_frame=MAX_FRAME):
+        self.framing = framing
+        self.max_frame = max_frame
+        self.buffer = bytearray()
+        self.pos = 0   # Start of the first unparsed frame
+        self.scan = 0  # Where to resume looking for a newline
+        self.decompressor = None
+        self.fed = 0   # Bytes fed in, after decompression
+
+    def feed(self, data):
+        """Add received bytes to the buffer"""
+        if self.decompressor is not None:
+            data = self.decompressor.decompress(data)
+        self.fed += len(data)
+        if self.pos:
+            # Drop parsed frames once per read instead of once per frame
+            del self.buffer[:self.pos]
+            self.scan -= self.pos
+            self.pos = 0
+        self.buffer += data
+
+    def decompress(self):
+        """Inflate everything after the frames parsed so far. Like a
+        framing change, this is done between two next_message() calls,
+        right after the welcome
+        """
+        self.decompressor = zlib.decompressobj(DEFLATE_WBITS)
+        rest = bytes(self.buffer[self.pos:])
+        del self.buffer[self.pos:]
+        self.scan = self.pos
+        self.fed -= len(rest)
+        self.feed(rest)
+
+    def buffered(self):
+        """Bytes received but not parsed yet"""
+        return len(self.buffer) - self.pos
+
+    def next_frame(self):
+        """The next complete raw frame body, or None if more data is needed"""
+        if self.framing == BINARY:
+            if len(self.buffer) - self.pos < LENGTH.size:
+                return None
+            length = LENGTH.unpack_from(self.buffer, self.pos)[0]
+            if length > self.max_frame:
+                raise FrameError(f"Frame of {length} bytes is too large")
+            start = self.pos + LENGTH.size
+            end = start + length
+            if len(self.buffer) < end:
+                return None
+            self.pos = self.scan = end
+            return memoryview(self.buffer)[start:end]
+
+        newline = self.buffer.find(b'\n', max(self.scan, self.pos))
+        if newline < 0:
+            self.scan = len(self.buffer)
+            if self.buffered() > self.max_frame:
+                raise FrameError("Line is too long")
+            return None
+        start = self.pos
+        self.pos = self.scan = newline + 1
+        return memoryview(self.buffer)[start:newline]
+
+    def next_message(self):
+        """Decode the next complete frame, or return None if there isn't one"""
+        frame = self.next_frame()
+        if frame is None:
+            return None
+        with frame:
+            if self.framing == BINARY:
+                return decode_binary(frame)
+            return decode_line(frame)
+
+    def messages(self):
+        """Yield every complete message in the buffer"""
+        while True:
+            message = self.next_message()
+            if message is None:
+                return
+            yield message
@@ -0,0 +1,126 @@
+import time
+from framing import KIND_TYPING
+
+class TokenBucket:
+    """Allows rate events per second on average, in bursts of up to burst.
+
+    A rate of 0 or less means unlimited.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Spend a token, returning False if there is none left"""
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+# Frames shed or refused since the server started, by reason
+violations = {"frame_rate": 0, "chat_rate": 0, "typing_rate": 0, "frame_size": 0}
+
+class ClientLimits:
+    """What one connection may send, enforced before a frame is handled.
+
+    Every frame first spends a token from a frame bucket, before anything
+    is parsed, so a flood costs the server little whatever it contains.
+    Then chat messages (and everything else that isn't typing status) and
+    typing updates have separate token buckets, so a client hammering one
+    can't starve the other. Binary frames are judged by their kind byte;
+    JSON lines have to be parsed first to tell which bucket they belong to. Oversized frames cost the client its connection, since
+    the stream can't be trusted after one.
+    """
+
+    # Defaults, overridden from the command line through configure()
+    frame_rate = 20.0      # Frames of any kind per second, checked before parsing
+    frame_burst = 40
+    chat_rate = 5.0        # Chat messages per second, on average
+    chat_burst = 20        # Chat messages allowed back to back
+    typing_rate = 5.0      # Typing updates per second; clients send about one
+    typing_burst = 10
+    max_frame = 64 * 1024  # Largest frame accepted, in either framing
+    max_buffer = 256 * 1024  # Received bytes held before parsing; reading pauses past this
+
+    def __init__(self):
+        self.frames = TokenBucket(self.frame_rate, self.frame_burst)
+        self.chat = TokenBucket(self.chat_rate, self.chat_burst)
+        self.typing = TokenBucket(self.typing_rate, self.typing_burst)
+        self.warned = False  # Told the client we're dropping its messages
+
+    def check_frame(self):
+        """None if another frame of any kind fits the budget, otherwise the
+        violation, which is counted
+        """
+        if self.frames.take():
+            return None
+        violations["frame_rate"] += 1
+        return "frame_rate"
+
+    def check(self, is_typing):
+        """None if the next frame fits the budget, otherwise the violation,
+        which is counted
+        """
+        if is_typing:
+            if self.typing.take():
+                return None
+            violation = "typing_rate"
+        else:
+            if self.chat.take():
+                self.warned = False
+                return None
+            violation = "chat_rate"
+        violations[violation] += 1
+        return violation
+
+    def check_binary(self, body):
+        """check() for a binary frame body, judged by its kind byte"""
+        return self.check(len(body) > 0 and body[0] == KIND_TYPING)
+
+    def check_message(self, message):
+        """check() for a decoded JSON line, judged by its type"""
+        return self.check(message.get("type") == "typing_status")
+
+    def should_warn(self, violation):
+        """Whether to tell the client about a violation: dropped chat
+        messages or frames, once until a message gets through again
+        """
+        if violation == "typing_rate" or self.warned:
+            return False
+        self.warned = True
+        return True
+
+    def frame_too_large(self, length):
+        """Check a frame length, counting a violation if it's too large"""
+        if length > self.max_frame:
+            violations["frame_size"] += 1
+            return True
+        return False
+
+def configure(frame_rate=None, frame_burst=None, chat_rate=None, chat_burst=None, typing_rate=None, typing_burst=None,
+              max_frame=None, max_buffer=None):
+    """Set the limits used for every new connection"""
+    if frame_rate is not None:
+        ClientLimits.frame_rate = frame_rate
+    if frame_burst is not None:
+        ClientLimits.frame_burst = frame_burst
+    if chat_rate is not None:
+        ClientLimits.chat_rate = chat_rate
+    if chat_burst is not None:
+        ClientLimits.chat_burst = chat_burst
+    if typing_rate is not None:
+        ClientLimits.typing_rate = typing_rate
+    if typing_burst is not None:
+        ClientLimits.typing_burst = typing_burst
+    if max_frame is not None:
+        ClientLimits.max_frame = max_frame
+    if max_buffer is not None:
+        ClientLimits.max_buffer = max_buffer
@@ -0,0 +1,306 @@
+import os
+import secrets
+import struct
+import threading
+from collections import deque
+from framing import LENGTH
+
+INDEX_ENTRY = struct.Struct('<Q')  # Byte offset of each record in the log
+FLUSH_INTERVAL = 1.0               # Seconds between batched write + fsync
+REPLAY_BYTES = 256 * 1024          # Most backlog bytes sent to a joining client
+RING_SIZE = 4096                   # Newest records kept in memory for resuming clients
+
+class ReplayRing:
+    """The newest records of a room, in memory.
+
+    Hands out seqs like MessageLog and serves resuming clients without
+    touching the disk. On its own it stands in for MessageLog when history
+    is off: seqs and short-term resume still work, nothing is persisted.
+    Seqs then start over with every server run, so each ring has a random
+    epoch that clients are told and hand back when they resume.
+    """
+
+    def __init__(self, capacity=RING_SIZE, first_seq=0):
+        self.records = deque(maxlen=capacity)
+        self.next_seq = first_seq
+        self.epoch = secrets.token_hex(8)
+        self.lock = threading.Lock()
+
+    @property
+    def first_seq(self):
+        """Oldest seq still in the ring"""
+        return self.next_seq - len(self.records)
+
+    def append(self, encode):
+        """Assign the next seq and keep encode(seq); returns (seq, record)"""
+        with self.lock:
+            seq = self.next_seq
+            record = encode(seq)
+            self.records.append(record)
+            self.next_seq += 1
+        return seq, record
+
+    def replay(self, start, end=None, max_bytes=REPLAY_BYTES):
+        """Records with start <= seq < end that are still in the ring,
+        newest first to go over max_bytes
+        """
+        with self.lock:
+            first = self.next_seq - len(self.records)
+            if end is None:
+                end = self.next_seq
+            start = max(start, first)
+            if start >= end:
+                return b""
+            records = [self.records[i] for i in range(end - first - 1, start - first - 1, -1)]
+        size = 0
+        for count, record in enumerate(records):
+            size += len(record)
+            if size > max_bytes:
+                records = records[:count]
+                break
+        return b"".join(reversed(records))
+
+    def replay_last(self, count, max_bytes=REPLAY_BYTES):
+        """The newest count records, concatenated"""
+        end = self.next_seq
+        return self.replay(end - count, end, max_bytes)
+
+    def close(self):
+        pass
+
+def backlog(log, count, last_seq=None, epoch=None):
+    """What a client joining a room is sent: everything after last_seq if
+    it is resuming, otherwise the newest count records.
+
+    A resuming client that saw a previous incarnation of an in-memory ring
+    (the server restarted with --no-history) was sent none of what this
+    one holds, so it gets all of it, as much as fits in a backlog. It is
+    recognised by an epoch other than the ring's or, from clients that
+    don't send one, by a last_seq the ring hasn't reached yet.
+    """
+    if last_seq is None:
+        return log.replay_last(count) if count else b""
+    if (epoch is not None and epoch != log.epoch) or last_seq >= log.next_seq:
+        return log.replay(0)
+    return log.replay(last_seq + 1)
+
+def with_epoch(settings, log):
+    """Room settings for a welcome or room message, with the log's epoch
+    if it has one
+    """
+    if log is None or log.epoch is None:
+        return settings
+    return dict(settings, epoch=log.epoch)
+
+class MessageLog:
+    """Append-only message log with a fixed-width offset index.
+
+    Records are binary frames (see framing.py), stored exactly as they go out
+    to binary clients, so replay is a single positioned read with no
+    re-encoding. The length prefix also delimits records on recovery.
+    The offset of record seq lives at seq * 8 in the index file, which makes
+    "last N" and "since S" lookups O(1) instead of a scan of the log.
+
+    append() only queues the record in memory; a background thread writes
+    and fsyncs pending records every flush_interval seconds, keeping disk
+    I/O off the broadcast path. The newest records also stay in a
+    ReplayRing, so resuming clients are served from memory.
+    """
+
+    epoch = None  # Seqs carry on across restarts
+
+    def __init__(self, directory, flush_interval=FLUSH_INTERVAL, ring_size=RING_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.flush_interval = flush_interval
+        self.log_fd = os.open(os.path.join(directory, "messages.log"),
+                              os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        self.index_fd = os.open(os.path.join(directory, "messages.idx"),
+                                os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        self.log_size = 0
+        self.flushed = 0  # Records safely on disk; pending[i] has seq flushed + i
+        self._recover()
+        self.ring = ReplayRing(ring_size, first_seq=self.flushed)
+
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()  # One flush at a time
+        self.pending = []
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    @property
+    def next_seq(self):
+        return self.flushed + len(self.pending)
+
+    def _offset(self, seq):
+        """Start of record seq in the log; seq == flushed gives the log size"""
+        if seq >= self.flushed:
+            return self.log_size
+        data = os.pread(self.index_fd, INDEX_ENTRY.size, seq * INDEX_ENTRY.size)
+        return INDEX_ENTRY.unpack(data)[0]
+
+    def _recover(self):
+        """Make the index and log agree after an unclean shutdown"""
+        log_size = os.fstat(self.log_fd).st_size
+        count = os.fstat(self.index_fd).st_size // INDEX_ENTRY.size
+        self.log_size = log_size
+
+        # Drop index entries that point past the end of the log
+        self.flushed = count
+        while count and self._offset(count - 1) >= log_size:
+            count -= 1
+            self.flushed = count
+        os.ftruncate(self.index_fd, count * INDEX_ENTRY.size)
+
+        # Re-index complete records that made it to the log but not the index
+        position = self._offset(count - 1) if count else 0
+        tail = os.pread(self.log_fd, log_size - position, position)
+        end = 0
+        offsets = []
+        while end + LENGTH.size <= len(tail):
+            record_end = end + LENGTH.size + LENGTH.unpack_from(tail, end)[0]
+            if record_end > len(tail):
+                break
+            offsets.append(position + end)
+            end = record_end
+        end += position
+        if count:
+            offsets = offsets[1:]  # The first one is already indexed
+        if offsets:
+            os.write(self.index_fd, b"".join(INDEX_ENTRY.pack(o) for o in offsets))
+            count += len(offsets)
+
+        # Cut off a partially written trailing record
+        if end < log_size:
+            os.ftruncate(self.log_fd, end)
+        self.log_size = end
+        self.flushed = count
+
+    def append(self, encode):
+        """Assign the next seq and queue encode(seq) as its record.
+
+        encode must return a complete binary frame. Returns (seq, record) so
+        the caller can broadcast the same bytes.
+        """
+        with self.lock:
+            seq, record = self.ring.append(encode)
+            self.pending.append(record)
+        return seq, record
+
+    def replay(self, start, end=None, max_bytes=REPLAY_BYTES):
+        """Records with start <= seq < end, concatenated.
+
+        When the range is larger than max_bytes the oldest records are left
+        out, so the newest ones are always delivered.
+        """
+        if start >= self.ring.first_seq:
+            return self.ring.replay(start, end, max_bytes)
+        with self.lock:
+            flushed = self.flushed
+            pending = self.pending[:]
+        if end is None:
+            end = flushed + len(pending)
+        start = max(start, 0)
+        if start >= end:
+            return b""
+
+        # Records still in memory are the newest, take them first
+        tail = pending[max(start - flushed, 0):max(end - flushed, 0)]
+        budget = max_bytes - sum(len(record) for record in tail)
+        while tail and budget < 0:
+            budget += len(tail.pop(0))
+
+        disk_end = min(end, flushed)
+        if start >= disk_end or budget <= 0:
+            return b"".join(tail)
+
+        with self.write_lock:  # Keeps flushed/log_size steady while we read
+            stop = self._offset(disk_end)
+            if stop - self._offset(start) > budget:
+                # Binary search the index for the oldest record that fits
+                lo, hi = start, disk_end
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if stop - self._offset(mid) > budget:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                start = lo
+            offset = self._offset(start)
+            disk = os.pread(self.log_fd, stop - offset, offset)
+        return disk + b"".join(tail)
+
+    def replay_last(self, count, max_bytes=REPLAY_BYTES):
+        """The newest count records, concatenated"""
+        end = self.next_seq
+        return self.replay(end - count, end, max_bytes)
+
+    def _flush_loop(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Write and fsync everything appended so far in one batch"""
+        with self.write_lock:
+            with self.lock:
+                batch = self.pending[:]
+            if not batch:
+                return
+
+            offsets = []
+            offset = self.log_size
+            for record in batch:
+                offsets.append(offset)
+                offset += len(record)
+            os.write(self.log_fd, b"".join(batch))
+            # The log is durable before the index points into it, so an
+            # indexed record is always complete after a crash
+            os.fsync(self.log_fd)
+            os.write(self.index_fd, b"".join(INDEX_ENTRY.pack(o) for o in offsets))
+            os.fsync(self.index_fd)
+
+            with self.lock:
+                self.log_size = offset
+                self.flushed += len(batch)
+                del self.pending[:len(batch)]
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.flush()
+        os.close(self.log_fd)
+        os.close(self.index_fd)
+
+class RoomLogs:
+    """One MessageLog per room, opened on first use.
+
+    The default room keeps its log at the top of the directory, where it
+    was before there were rooms; the others live in rooms/<name>/. Without
+    a directory every room gets a ReplayRing instead, kept in memory only.
+    """
+
+    def __init__(self, directory, default_room, flush_interval=FLUSH_INTERVAL):
+        self.directory = directory
+        self.default_room = default_room
+        self.flush_interval = flush_interval
+        self.logs = {}
+        self.lock = threading.Lock()
+
+    def get(self, room):
+        with self.lock:
+            log = self.logs.get(room)
+            if log is None and self.directory is None:
+                log = self.logs[room] = ReplayRing()
+            elif log is None:
+                directory = self.directory
+                if room != self.default_room:
+                    directory = os.path.join(directory, "rooms", room)
+                log = self.logs[room] = MessageLog(directory, self.flush_interval)
+            return log
+
+    def close(self):
+        with self.lock:
+            for log in self.logs.values():
+                log.close()
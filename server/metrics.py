@@ -0,0 +1,124 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Counters, gauges and histograms in the Prometheus text format, served
+# over HTTP on the admin port. Updating one is a Python attribute
+# increment, so instrumenting the hot path costs next to nothing; all
+# formatting happens when something scrapes /metrics.
+
+registry = []  # Every metric, in the order they're rendered
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+class Counter:
+    """A value that only goes up. labels() returns a child per label set.
+
+    Instead of inc(), a metric kept elsewhere can be given as read: a
+    function returning a number, or a {value of label: number} dict.
+    """
+
+    type = "counter"
+
+    def __init__(self, name, help, read=None, label=None, register=True):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.label = label
+        self.value = 0
+        self.children = {}
+        if register:
+            registry.append(self)
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def labels(self, **labels):
+        key = tuple(sorted(labels.items()))
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = type(self)(self.name, self.help, register=False)
+        return child
+
+    def samples(self):
+        if self.read is not None:
+            value = self.read()
+            if isinstance(value, dict):
+                return [(self.name, ((self.label, k),), v) for k, v in value.items()]
+            return [(self.name, (), value)]
+        if not self.children:
+            return [(self.name, (), self.value)]
+        # Scrapes run on their own thread; copy before iterating
+        return [(self.name, key, child.value) for key, child in list(self.children.items())]
+
+class Gauge(Counter):
+    """A value that can go both ways"""
+
+    type = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+class Histogram:
+    """Observations counted into fixed buckets"""
+
+    type = "histogram"
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        registry.append(self)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+            cumulative += count
+            samples.append((self.name + "_bucket", (("le", bound),), cumulative))
+        samples.append((self.name + "_sum", (), self.sum))
+        samples.append((self.name + "_count", (), self.count))
+        return samples
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes aren't worth a line each
+
+def serve(host, port):
+    """Serve /metrics on a background thread; returns the HTTP server"""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
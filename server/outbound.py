@@ -0,0 +1,89 @@
+import socket
+from collections import deque
+
+class SlowConsumer(Exception):
+    """Raised when a client's outbound queue overflows and it should be dropped"""
+
+class OutboundQueue:
+    """Bounded queue of encoded frames waiting to be written to one client.
+
+    The queue itself does no locking or I/O; each server engine wraps it with
+    its own wakeup primitive and writer. When it fills up, droppable frames
+    (typing status, on the threaded engine) are shed first and only then is
+    the client disconnected.
+    """
+
+    # Defaults, overridden from the command line through configure()
+    max_frames = 256
+    max_bytes = 1024 * 1024
+    shed_typing = True
+    flush_tick = 0.0  # Seconds a writer waits for more frames before writing; 0 writes at once
+    nodelay = True    # Set TCP_NODELAY on client sockets
+
+    def __init__(self):
+        self.frames = deque()  # (data, droppable) pairs
+        self.queued_bytes = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def _is_full(self, size):
+        return (len(self.frames) >= self.max_frames or
+                self.queued_bytes + size > self.max_bytes)
+
+    def _shed_droppable(self):
+        """Remove the oldest droppable frame, returning True if one was found"""
+        for i, (data, droppable) in enumerate(self.frames):
+            if droppable:
+                del self.frames[i]
+                self.queued_bytes -= len(data)
+                self.dropped += 1
+                return True
+        return False
+
+    def put(self, data, droppable=False):
+        """Queue a frame, returning False if it was dropped.
+
+        Raises SlowConsumer when a non-droppable frame doesn't fit.
+        """
+        size = len(data)
+        if self._is_full(size):
+            if not self.shed_typing:
+                raise SlowConsumer()
+            if droppable:
+                self.dropped += 1
+                return False
+            while self._is_full(size):
+                if not self._shed_droppable():
+                    raise SlowConsumer()
+        self.frames.append((data, droppable))
+        self.queued_bytes += size
+        return True
+
+    def take_all(self):
+        """Remove and return every queued frame, oldest first"""
+        frames = [data for data, _ in self.frames]
+        self.frames.clear()
+        self.queued_bytes = 0
+        return frames
+
+def set_nodelay(sock):
+    """Apply the TCP_NODELAY setting to a client socket"""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(OutboundQueue.nodelay))
+    except OSError:
+        pass  # Not TCP
+
+def configure(max_frames=None, max_bytes=None, shed_typing=None, flush_tick=None, nodelay=None):
+    """Set the slow-consumer and write policy used by every new OutboundQueue"""
+    if max_frames is not None:
+        OutboundQueue.max_frames = max_frames
+    if max_bytes is not None:
+        OutboundQueue.max_bytes = max_bytes
+    if shed_typing is not None:
+        OutboundQueue.shed_typing = shed_typing
+    if flush_tick is not None:
+        OutboundQueue.flush_tick = flush_tick
+    if nodelay is not None:
+        OutboundQueue.nodelay = nodelay
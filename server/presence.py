@@ -0,0 +1,134 @@
+import time
+
+TYPING_TIMEOUT = 3.0  # Seconds a typing update lasts unless refreshed
+TYPING_TICK = 0.25    # Seconds between "who is typing" snapshots
+ROSTER_TICK = 0.5     # Seconds joins and leaves are collected before they're announced
+
+class TypingPresence:
+    """Who is typing in each room, expired by the server.
+
+    Typing updates only change this table; tick() then reports each room
+    whose set of typists changed since the last tick, so a room gets at
+    most one snapshot per tick however many keystrokes arrive.
+    """
+
+    def __init__(self, timeout=TYPING_TIMEOUT):
+        self.timeout = timeout
+        self.typing = {}     # Room -> {username: expiry time}
+        self.announced = {}  # Room -> tuple of usernames in its last snapshot
+
+    def update(self, room, username, is_typing):
+        if is_typing:
+            self.typing.setdefault(room, {})[username] = time.monotonic() + self.timeout
+        else:
+            self.remove(room, username)
+
+    def remove(self, room, username):
+        """Stop showing a user as typing: they sent a message or left"""
+        typists = self.typing.get(room)
+        if typists is not None and typists.pop(username, None) is not None and not typists:
+            del self.typing[room]
+
+    def typists(self, room):
+        """Users in the room's last snapshot"""
+        return self.announced.get(room, ())
+
+    def tick(self):
+        """Expire stale entries; returns (room, users, previous) for every
+        room whose typists changed since the last call
+        """
+        now = time.monotonic()
+        changes = []
+        for room in set(self.typing) | set(self.announced):
+            typists = self.typing.get(room)
+            if typists:
+                for username in [u for u, expiry in typists.items() if expiry <= now]:
+                    del typists[username]
+                if not typists:
+                    del self.typing[room]
+            users = tuple(sorted(typists)) if typists else ()
+            previous = self.announced.get(room, ())
+            if users == previous:
+                continue
+            if users:
+                self.announced[room] = users
+            else:
+                del self.announced[room]
+            changes.append((room, users, previous))
+        return changes
+
+class Roster:
+    """Who is in each room, with joins and leaves announced in batches.
+
+    join() and leave() only change the table; tick() then reports who
+    joined and who left each room since the last tick, so a reconnect
+    storm costs each member one notice per tick instead of one per
+    client. Connections are counted per username: a user only joins with
+    their first connection and leaves with their last, and one who drops
+    and comes back within a tick isn't announced at all.
+    """
+
+    def __init__(self):
+        self.members = {}  # Room -> {username: connections}
+        self.changed = {}  # Room -> {username: whether they were in it at the last tick}
+
+    def join(self, room, username):
+        members = self.members.setdefault(room, {})
+        if username not in members:
+            self.changed.setdefault(room, {}).setdefault(username, False)
+        members[username] = members.get(username, 0) + 1
+
+    def leave(self, room, username):
+        members = self.members.get(room)
+        if members is None or username not in members:
+            return
+        members[username] -= 1
+        if members[username]:
+            return
+        del members[username]
+        if not members:
+            del self.members[room]
+        self.changed.setdefault(room, {}).setdefault(username, True)
+
+    def users(self, room):
+        """Everyone in the room now, announced or not"""
+        return list(self.members.get(room, ()))
+
+    def _delta(self, room, users):
+        members = self.members.get(room, {})
+        joined = [u for u, was_in in users.items() if not was_in and u in members]
+        left = [u for u, was_in in users.items() if was_in and u not in members]
+        return joined, left
+
+    def tick(self):
+        """Returns (room, joined, left) for every room whose members changed
+        since the last call, each list in the order it happened
+        """
+        changes = []
+        for room, users in self.changed.items():
+            joined, left = self._delta(room, users)
+            if joined or left:
+                changes.append((room, joined, left))
+        self.changed.clear()
+        return changes
+
+    def flush(self, room, username):
+        """(joined, left) for the room now, ahead of the tick, if username's
+        arrival there hasn't been announced yet; otherwise None. Called
+        before relaying a message, so nobody hears from someone they
+        haven't seen join.
+        """
+        users = self.changed.get(room)
+        if users is None or username not in users:
+            return None
+        del self.changed[room]
+        joined, left = self._delta(room, users)
+        return (joined, left) if joined or left else None
+
+def describe(users, verb, shown=2):
+    """Name a few users and count the rest: alice, bob and 40 others joined"""
+    if len(users) > shown + 1:
+        return f"{', '.join(users[:shown])} and {len(users) - shown} others {verb}"
+    if len(users) > 1:
+        return f"{', '.join(users[:-1])} and {users[-1]} {verb}"
+    return f"{users[0]} {verb}"
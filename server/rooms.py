@@ -0,0 +1,57 @@
+import base64
+import json
+import os
+import re
+
+DEFAULT_ROOM = "lobby"
+KDF_ITERATIONS = 100000  # PBKDF2 iterations for newly created rooms
+SALT_BYTES = 16
+# Message ciphers clients understand. Rooms created before ciphers were
+# selectable have no "cipher" entry, which clients read as Fernet.
+CIPHERS = ("aes-gcm", "chacha20-poly1305", "fernet")
+DEFAULT_CIPHER = "aes-gcm"
+# Room names double as directory names for their message logs
+ROOM_NAME = re.compile(r'[A-Za-z0-9_-]{1,32}')
+
+def valid_room(name):
+    return isinstance(name, str) and ROOM_NAME.fullmatch(name) is not None
+
+class RoomSettings:
+    """Per-room key-derivation parameters and cipher, persisted as JSON.
+
+    Every room gets a random salt the first time it is used. Clients derive
+    their key from the room password with it, so the salt has to outlive
+    restarts or clients would stop agreeing on keys (and the message log
+    would become unreadable).
+    """
+
+    def __init__(self, path, iterations=KDF_ITERATIONS, cipher=DEFAULT_CIPHER):
+        self.path = path
+        self.iterations = iterations
+        self.cipher = cipher
+        self.rooms = {}
+        try:
+            with open(path) as f:
+                self.rooms = json.load(f)
+        except FileNotFoundError:
+            pass
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.rooms, f, indent=2)
+        os.replace(temp_path, self.path)
+
+    def get(self, room):
+        """Settings for a room, creating them on first use"""
+        settings = self.rooms.get(room)
+        if settings is None:
+            settings = {
+                "salt": base64.b64encode(os.urandom(SALT_BYTES)).decode(),
+                "kdf_iterations": self.iterations,
+                "cipher": self.cipher
+            }
+            self.rooms[room] = settings
+            self._save()
+        return settings
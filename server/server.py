@@ -1,99 +1,379 @@
-import socket
-import threading
-import json
-
-HOST = '0.0.0.0'     # Listens on all interfaces
-PORT = 9999          # Match client's default port
-
-clients = {}         # Maps client socket -> username
-lock = threading.Lock()
-
-def broadcast(message_dict, sender_socket=None):
-    """Send a message to all clients except the sender"""
-    message_json = json.dumps(message_dict) + "\n"  # Add newline as message delimiter
-    with lock:
-        for client_sock in clients:
-            if client_sock != sender_socket:
-                try:
-                    client_sock.send(message_json.encode('utf-8'))
-                except:
-                    client_sock.close()
-
-def handle_client(client_sock, addr):
-    try:
-        # Receive the first message containing username
-        data = client_sock.recv(4096)
-        if not data:
-            return
-            
-        message = json.loads(data.decode('utf-8'))
-        username = message.get("username", "Anonymous")
-        
-        with lock:
-            clients[client_sock] = username
-        print(f"[+] {username} connected from {addr}")
-
-        # Notify everyone about the new user
-        broadcast({
-            "type": "message",
-            "username": "System",
-            "content": f"{username} has joined the chat"
-        })
-
-        buffer = ""
-        while True:
-            data = client_sock.recv(4096)
-            if not data:
-                break
-                
-            buffer += data.decode('utf-8')
-            
-            # Split buffer into messages by newline
-            while '\n' in buffer:
-                message_json, buffer = buffer.split('\n', 1)
-                try:
-                    message = json.loads(message_json)
-                    if message.get("type") == "message":
-                        username = message.get("username", "Anonymous")
-                        content = message.get("content", "")
-                        print(f"{username}: {content}")
-                        # Forward to other clients
-                        broadcast(message, sender_socket=client_sock)
-                    elif message.get("type") == "typing_status":
-                        # Forward typing status to other clients
-                        broadcast(message, sender_socket=client_sock)
-                except json.JSONDecodeError as e:
-                    print(f"Error decoding message: {e}")
-                except Exception as e:
-                    print(f"Error processing message: {e}")
-                
-    except Exception as e:
-        print(f"Error: {e}")
-    finally:
-        with lock:
-            left_user = clients.get(client_sock, "Someone")
-            if client_sock in clients:
-                del clients[client_sock]
-                
-        print(f"[-] {left_user} disconnected.")
-        broadcast({
-            "type": "message", 
-            "username": "System", 
-            "content": f"{left_user} has left the chat"
-        })
-        client_sock.close()
-
-def main():
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind((HOST, PORT))
-    server.listen()
-
-    print(f"[💬 Server started] Listening on port {PORT}...")
-
-    while True:
-        client_sock, addr = server.accept()
-        threading.Thread(target=handle_client, args=(client_sock, addr), daemon=True).start()
-
-if __name__ == "__main__":
-    main()
+import argparse
+import os
+import signal
+import socket
+import threading
+import time
+import logging
+import metrics
+from outbound import OutboundQueue, SlowConsumer, set_nodelay
+import outbound
+import limits
+from limits import ClientLimits, violations
+from message_log import RoomLogs, FLUSH_INTERVAL
+from rooms import RoomSettings, DEFAULT_ROOM, KDF_ITERATIONS, CIPHERS, DEFAULT_CIPHER
+from framing import (FrameReader, FrameError, LINES, encode_line, encode_binary, decode_line,
+                     convert_frames)
+
+HOST = '0.0.0.0'     # Listens on all interfaces
+PORT = 9999          # Match client's default port
+
+clients = {}         # Maps client socket -> ClientConnection
+lock = threading.Lock()
+history = None       # RoomLogs of chat messages, in memory only with --no-history
+replay_count = 50    # Messages replayed to a client when it joins
+IOV_MAX = 1024       # Buffers one sendmsg() call may take on Linux and the BSDs
+TOO_FAST = {         # Sent once when a client's messages start being dropped
+    "type": "message",
+    "username": "System",
+    "content": "You're sending too fast, messages are being dropped"
+}
+log = logging.getLogger("cowtalk")
+
+class ClientConnection:
+    """A connected client with its own outbound queue and writer thread"""
+
+    def __init__(self, sock, username):
+        self.sock = sock
+        self.username = username
+        self.queue = OutboundQueue()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def send(self, data, droppable=False):
+        """Queue an encoded frame without touching the socket"""
+        with self.cond:
+            if self.closed:
+                return
+            try:
+                self.queue.put(data, droppable)
+            except SlowConsumer:
+                log.warning("[!] %s is not keeping up, disconnecting", self.username)
+                self._close_locked()
+                return
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self._close_locked()
+
+    def _close_locked(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.cond.notify()
+        try:
+            # Wakes up the reader in handle_client so it cleans up
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write_loop(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+            if OutboundQueue.flush_tick > 0:
+                # Let whatever else arrives within the tick share this write
+                time.sleep(OutboundQueue.flush_tick)
+            with self.cond:
+                frames = self.queue.take_all()
+            try:
+                send_frames(self.sock, frames)
+            except OSError:
+                self.close()
+                return
+
+def broadcast(message_dict, sender_socket=None):
+    """Send a message to all clients except the sender"""
+    data = encode_line(message_dict)
+    droppable = message_dict.get("type") == "typing_status"
+    # Snapshot the recipients so no socket I/O happens while holding the lock
+    with lock:
+        recipients = [conn for sock, conn in clients.items() if sock != sender_socket]
+    for conn in recipients:
+        conn.send(data, droppable)
+
+def publish(message_dict, sender_socket=None):
+    """Record a chat message in the history, then broadcast it"""
+    if history is None:
+        broadcast(message_dict, sender_socket)
+        return
+    with lock:
+        # Logging under the lock keeps seqs in the order clients see them.
+        # This engine has no rooms, everyone is in the default one
+        seq, _ = history.get(DEFAULT_ROOM).append(
+            lambda seq: encode_binary(dict(message_dict, seq=seq)))
+        recipients = [conn for sock, conn in clients.items() if sock != sender_socket]
+    data = encode_line(dict(message_dict, seq=seq))
+    for conn in recipients:
+        conn.send(data)
+
+def send_frames(sock, frames):
+    """Write frames with as few syscalls as possible, handling partial writes"""
+    if not hasattr(sock, "sendmsg"):  # Windows
+        sock.sendall(b"".join(frames))
+        return
+    buffers = [memoryview(frame) for frame in frames]
+    while buffers:
+        sent = sock.sendmsg(buffers[:IOV_MAX])
+        # Skip the buffers that went out in full and trim the one cut short
+        done = 0
+        while done < len(buffers) and sent >= len(buffers[done]):
+            sent -= len(buffers[done])
+            done += 1
+        del buffers[:done]
+        if sent:
+            buffers[0] = buffers[0][sent:]
+
+def handle_client(client_sock, addr):
+    # This engine only speaks newline-delimited JSON. It never answers a
+    # framing request, which tells negotiating clients to stay on JSON lines
+    reader = FrameReader(max_frame=ClientLimits.max_frame)
+    budget = ClientLimits()
+    try:
+        # Read until the first complete message, which contains the username
+        message = None
+        while message is None:
+            data = client_sock.recv(4096)
+            if not data:
+                return
+            reader.feed(data)
+            message = reader.next_message()
+
+        username = message.get("username", "Anonymous")
+        
+        joined = {
+            "type": "message",
+            "username": "System",
+            "content": f"{username} has joined the chat"
+        }
+        conn = ClientConnection(client_sock, username)
+        with lock:
+            clients[client_sock] = conn
+            # Join notice then backlog, queued before any live message can be
+            conn.send(encode_line(joined))
+            if history is not None and replay_count:
+                backlog = history.get(DEFAULT_ROOM).replay_last(replay_count)
+                if backlog:
+                    conn.send(convert_frames(backlog, LINES))
+        log.info("[+] %s connected from %s", username, addr)
+
+        # Notify everyone else about the new user
+        broadcast(joined, sender_socket=client_sock)
+
+        while True:
+            # Handle everything already buffered before reading more
+            while True:
+                try:
+                    frame = reader.next_frame()
+                except FrameError:
+                    violations["frame_size"] += 1
+                    raise  # Oversized line, drop the client
+                if frame is None:
+                    break
+                with frame:
+                    frame = bytes(frame)  # Let the reader reuse its buffer
+                # Shed floods before parsing them; after that a line's type
+                # decides its budget
+                violation = budget.check_frame()
+                if violation:
+                    if budget.should_warn(violation):
+                        conn.send(encode_line(TOO_FAST))
+                    continue
+                try:
+                    message = decode_line(frame)
+                except ValueError as e:
+                    # It never reached its budget, so it's charged as chat
+                    if not budget.check(False):
+                        log.warning("Error decoding message: %s", e)
+                    continue
+                violation = budget.check_message(message)
+                if violation:
+                    if budget.should_warn(violation):
+                        conn.send(encode_line(TOO_FAST))
+                    continue
+                try:
+                    if message.get("type") == "message":
+                        username = message.get("username", "Anonymous")
+                        content = message.get("content", "")
+                        if not isinstance(content, (str, bytes)):
+                            log.warning("Dropped a message from %s: content of type %s",
+                                        conn.username, type(content).__name__)
+                            continue
+                        log.debug("%s: %s", username, content)
+                        # Forward to other clients
+                        publish(message, sender_socket=client_sock)
+                    elif message.get("type") == "typing_status":
+                        # Forward typing status to other clients
+                        broadcast(message, sender_socket=client_sock)
+                except Exception as e:
+                    log.error("Error processing message: %s", e)
+
+            data = client_sock.recv(4096)
+            if not data:
+                break
+            reader.feed(data)
+
+    except Exception as e:
+        log.error("Error: %s", e)
+    finally:
+        with lock:
+            conn = clients.pop(client_sock, None)
+        left_user = conn.username if conn else "Someone"
+        if conn:
+            conn.close()
+
+        log.info("[-] %s disconnected.", left_user)
+        broadcast({
+            "type": "message", 
+            "username": "System", 
+            "content": f"{left_user} has left the chat"
+        })
+        client_sock.close()
+
+def serve_threads(host, port, admin=None):
+    """Legacy engine: one thread per connected client"""
+    if admin is not None:
+        # Only what this engine already tracks; the asyncio one has the rest
+        metrics.Gauge("cowtalk_connections", "Connected clients", read=lambda: len(clients))
+        metrics.Counter("cowtalk_limit_violations_total", "Frames refused by per-client limits",
+                        label="reason", read=lambda: dict(violations))
+        metrics.serve(*admin)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen()
+
+    log.info("[💬 Server started] Listening on port %d...", port)
+
+    while True:
+        client_sock, addr = server.accept()
+        set_nodelay(client_sock)
+        threading.Thread(target=handle_client, args=(client_sock, addr), daemon=True).start()
+
+def main():
+    global history, replay_count
+    parser = argparse.ArgumentParser(description="cowtalk chat server")
+    parser.add_argument("--host", default=HOST, help="Interface to listen on")
+    parser.add_argument("--port", type=int, default=PORT, help="Port to listen on")
+    parser.add_argument("--engine", choices=["asyncio", "threads"], default="asyncio",
+                        help="asyncio event loop (default) or legacy thread-per-connection")
+    parser.add_argument("--send-queue", type=int, default=OutboundQueue.max_frames,
+                        help="Frames buffered per client before it counts as a slow consumer")
+    parser.add_argument("--send-queue-bytes", type=int, default=OutboundQueue.max_bytes,
+                        help="Bytes buffered per client before it counts as a slow consumer")
+    parser.add_argument("--slow-consumer", choices=["shed", "disconnect"], default="shed",
+                        help="On overflow, drop typing updates before disconnecting (shed) "
+                             "or disconnect straight away (threads engine; the asyncio engine "
+                             "never drops frames, it disconnects)")
+    parser.add_argument("--flush-tick", type=float, default=OutboundQueue.flush_tick,
+                        help="Seconds to collect frames for a client before writing them in one "
+                             "syscall, e.g. 0.002 (0 writes at once)")
+    parser.add_argument("--no-nodelay", action="store_true",
+                        help="Leave Nagle's algorithm on for client sockets")
+    parser.add_argument("--frame-rate", type=float, default=ClientLimits.frame_rate,
+                        help="Frames of any kind per second each client may send, checked "
+                             "before they're parsed (0: unlimited)")
+    parser.add_argument("--frame-burst", type=int, default=ClientLimits.frame_burst,
+                        help="Frames a client may send back to back")
+    parser.add_argument("--chat-rate", type=float, default=ClientLimits.chat_rate,
+                        help="Chat messages per second each client may send (0: unlimited)")
+    parser.add_argument("--chat-burst", type=int, default=ClientLimits.chat_burst,
+                        help="Chat messages a client may send back to back")
+    parser.add_argument("--typing-rate", type=float, default=ClientLimits.typing_rate,
+                        help="Typing updates per second each client may send (0: unlimited)")
+    parser.add_argument("--typing-burst", type=int, default=ClientLimits.typing_burst,
+                        help="Typing updates a client may send back to back")
+    parser.add_argument("--max-frame", type=int, default=ClientLimits.max_frame,
+                        help="Largest frame or line a client may send, in bytes")
+    parser.add_argument("--max-buffer", type=int, default=ClientLimits.max_buffer,
+                        help="Received bytes held per client before parsing (asyncio engine)")
+    parser.add_argument("--data-dir", default="cowtalk_data",
+                        help="Directory for the persistent message log")
+    parser.add_argument("--no-history", action="store_true",
+                        help="Don't log messages or replay them to new clients "
+                             "(reconnecting clients still get what they missed)")
+    parser.add_argument("--replay", type=int, default=replay_count,
+                        help="Number of past messages sent to a client when it joins")
+    parser.add_argument("--fsync-interval", type=float, default=FLUSH_INTERVAL,
+                        help="Seconds between batched writes of the message log")
+    parser.add_argument("--kdf-iterations", type=int, default=KDF_ITERATIONS,
+                        help="PBKDF2 iterations for new rooms (see client --benchmark-kdf)")
+    parser.add_argument("--cipher", choices=CIPHERS, default=DEFAULT_CIPHER,
+                        help="Message cipher clients use in new rooms")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes sharing the port (asyncio engine, needs SO_REUSEPORT)")
+    parser.add_argument("--no-relay", action="store_true",
+                        help="Decode and re-encode every binary frame instead of relaying it")
+    parser.add_argument("--compression-level", type=int, default=6, choices=range(10),
+                        metavar="0-9",
+                        help="zlib level for clients that ask for compression; 0 refuses them")
+    parser.add_argument("--capture", metavar="FILE",
+                        help="Record every inbound frame to a trace for bench/replay.py "
+                             "(asyncio engine; worker N writes FILE.N)")
+    parser.add_argument("--log-level", choices=["debug", "info", "warning", "error"], default="info",
+                        help="debug also logs every message")
+    parser.add_argument("--admin-port", type=int,
+                        help="Serve Prometheus metrics at /metrics on this port "
+                             "(worker N of --workers uses the port plus N)")
+    parser.add_argument("--admin-host", default="127.0.0.1", help="Interface for --admin-port")
+    args = parser.parse_args()
+    if args.capture and args.engine != "asyncio":
+        parser.error("--capture needs the asyncio engine")
+
+    logging.basicConfig(format="%(message)s", level=args.log_level.upper())
+    if args.engine != "asyncio":
+        # Stop on SIGTERM the way we do on Ctrl-C, so the log is flushed; the
+        # asyncio engine handles it on its event loop instead
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+    admin = None if args.admin_port is None else (args.admin_host, args.admin_port)
+
+    outbound.configure(
+        max_frames=args.send_queue,
+        max_bytes=args.send_queue_bytes,
+        shed_typing=args.slow_consumer == "shed",
+        flush_tick=args.flush_tick,
+        nodelay=not args.no_nodelay
+    )
+    limits.configure(
+        frame_rate=args.frame_rate,
+        frame_burst=args.frame_burst,
+        chat_rate=args.chat_rate,
+        chat_burst=args.chat_burst,
+        typing_rate=args.typing_rate,
+        typing_burst=args.typing_burst,
+        max_frame=args.max_frame,
+        max_buffer=args.max_buffer
+    )
+
+    if args.no_history:
+        history = RoomLogs(None, DEFAULT_ROOM)
+        replay_count = 0
+    else:
+        history = RoomLogs(args.data_dir, DEFAULT_ROOM, flush_interval=args.fsync_interval)
+        replay_count = args.replay
+    rooms = RoomSettings(os.path.join(args.data_dir, "rooms.json"),
+                         iterations=args.kdf_iterations, cipher=args.cipher)
+
+    try:
+        if args.engine == "asyncio":
+            import async_server
+            async_server.run(args.host, args.port, message_logs=history, replay=replay_count,
+                             relay=not args.no_relay, rooms=rooms, workers=args.workers,
+                             admin=admin, compression=args.compression_level,
+                             capture_file=args.capture)
+        else:
+            serve_threads(args.host, args.port, admin)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if history is not None:
+            history.close()
+
+if __name__ == "__main__":
+    main()